@@ -9,14 +9,26 @@ from dotenv import load_dotenv
 from datetime import timedelta, datetime as dt, timezone
 from discord.utils import utcnow
 import asyncio
+import hashlib
+import heapq
 import re
+import shlex
 from io import BytesIO
 import aiohttp
 import ast
+import json
 import sys
+import tempfile
+import time
 import traceback
 from contextlib import contextmanager
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, lru_cache
+from collections import OrderedDict, deque
+from dataclasses import dataclass, replace
+from typing import Optional
+from threading import Thread, Lock, RLock
+from queue import Queue
 import flask
 
 # ---------- ENVIRONMENT ----------
@@ -26,24 +38,120 @@ PREFIX = os.getenv("PREFIX", "!")
 DB_NAME = os.getenv("DB_PATH", "medieval_moderator.db")
 
 # ---------- ROYAL SEAL IMAGE ----------
-ROYAL_SEAL_URL = "https://imgs.search.brave.com/ybyUdUFEw0dNXKCLGu2FuNAlJpvCTxkjXZUxOSFKcMM/rs:fit:500:0:1:0/g:ce/aHR0cHM6Ly90aHVt/YnMuZHJlYW1zdGlt/ZS5jb20vYi9yb3lh/bC1kZWNyZWUtdW52/ZWlsZWQtZXhxdWlz/aXRlLWdvbGQtc2Vh/bC12aW50YWdlLXN0/YXRpb25lcnktaGFu/ZHdyaXR0ZW4tbGV0/dGVyLWV4cGxvcmUt/b3B1bGVuY2UtcmVn/YWwtc3RlcC1iYWNr/LTM1MTI2NjUwOC5q/cGc"# ---------- DATABASE CONNECTION MANAGER ----------
-@contextmanager
-def get_db_connection():
-    """Context manager for database connections to prevent race conditions"""
-    conn = None
-    try:
-        conn = sqlite3.connect(DB_NAME, timeout=10.0, isolation_level=None)
-        conn.execute("PRAGMA journal_mode=WAL") # Write-Ahead Logging for better concurrency
+ROYAL_SEAL_URL = "https://imgs.search.brave.com/ybyUdUFEw0dNXKCLGu2FuNAlJpvCTxkjXZUxOSFKcMM/rs:fit:500:0:1:0/g:ce/aHR0cHM6Ly90aHVt/YnMuZHJlYW1zdGlt/ZS5jb20vYi9yb3lh/bC1kZWNyZWUtdW52/ZWlsZWQtZXhxdWlz/aXRlLWdvbGQtc2Vh/bC12aW50YWdlLXN0/YXRpb25lcnktaGFu/ZHdyaXR0ZW4tbGV0/dGVyLWV4cGxvcmUt/b3B1bGVuY2UtcmVn/YWwtc3RlcC1iYWNr/LTM1MTI2NjUwOC5q/cGc"
+# ---------- DATABASE CONNECTION MANAGER ----------
+DB_READER_CONNECTIONS = int(os.getenv("DB_READER_CONNECTIONS", "3"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+class ConnectionManager:
+    """Long-lived SQLite connections: one serialized writer and a small pool of readers"""
+    def __init__(self, path, readers=3, cached_statements=256):
+        self.path = path
+        self.reader_limit = max(1, readers)
+        self.cached_statements = cached_statements
+        self._writer = None
+        self._writer_lock = RLock()
+        self._readers = Queue()
+        self._reader_count = 0
+        self._pool_lock = Lock()
+        self._connections = []
+    def _connect(self, readonly=False):
+        # Prepared statements are cached per connection, so they survive between helper calls
+        conn = sqlite3.connect(
+            self.path,
+            timeout=10.0,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
         conn.row_factory = sqlite3.Row
-        yield conn
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-        if conn:
-            conn.rollback()
-        raise
-    finally:
-        if conn:
-            conn.close()
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        else:
+            # Must come before WAL creates the file; existing databases are converted by migration 3
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL") # Write-Ahead Logging lets readers run alongside the writer
+        self._connections.append(conn)
+        return conn
+    @contextmanager
+    def writer(self):
+        """Borrow the single writer connection"""
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            try:
+                yield conn
+            except sqlite3.Error as e:
+                print(f"Database error: {e}")
+                raise
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only connection from the pool, opening one if the pool is not full yet"""
+        conn = None
+        with self._pool_lock:
+            if self._readers.empty() and self._reader_count < self.reader_limit:
+                self._reader_count += 1
+                conn = self._connect(readonly=True)
+        if conn is None:
+            conn = self._readers.get()
+        try:
+            yield conn
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            raise
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+    def close(self):
+        """Close every pooled connection (used on shutdown)"""
+        with self._writer_lock, self._pool_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections.clear()
+            self._writer = None
+            self._readers = Queue()
+            self._reader_count = 0
+db_pool = ConnectionManager(DB_NAME, readers=DB_READER_CONNECTIONS, cached_statements=DB_STATEMENT_CACHE_SIZE)
+def get_db_connection():
+    """Context manager for the shared writer connection (serialized to prevent race conditions)"""
+    return db_pool.writer()
+def get_db_reader():
+    """Context manager for a pooled read-only connection"""
+    return db_pool.reader()
+# ---------- ASYNC DATABASE LAYER ----------
+DB_QUEUE_SIZE = int(os.getenv("DB_QUEUE_SIZE", "1000"))
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "15"))
+class DatabaseExecutor:
+    """Runs the blocking database helpers on a dedicated thread so the event loop never waits on SQLite"""
+    def __init__(self, max_pending=1000, timeout=15.0):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="royal-db")
+        self._slots = asyncio.Semaphore(max_pending) # Bounded queue: callers wait here once it is full
+    async def _submit(self, func, args, kwargs):
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+    async def run(self, func, *args, timeout=None, **kwargs):
+        """Await a database helper; queries still waiting in the queue are dropped if the timeout expires"""
+        try:
+            return await asyncio.wait_for(self._submit(func, args, kwargs), self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            print(f"❌ Database call {func.__name__} timed out")
+            raise
+    def shutdown(self):
+        """Finish queued work and stop the database thread"""
+        self._executor.shutdown(wait=True)
+db_executor = DatabaseExecutor(max_pending=DB_QUEUE_SIZE, timeout=DB_QUERY_TIMEOUT)
+async def run_db(func, *args, timeout=None, **kwargs):
+    """Run a database helper on the database thread without blocking the event loop"""
+    return await db_executor.run(func, *args, timeout=timeout, **kwargs)
 # ---------- MEDIEVAL FLAIR ----------
 MEDIEVAL_COLORS = {
     "gold": discord.Colour.gold(),
@@ -267,8 +375,143 @@ intents.members = True
 intents.message_content = True
 intents.moderation = True
 intents.guilds = True
-bot = commands.Bot(command_prefix=PREFIX, intents=intents, help_command=None, case_insensitive=True)
+class MedievalBot(commands.Bot):
+    """Bot that drains buffered work before disconnecting"""
+    http_session = None # Shared aiohttp session for webhook and other non-gateway HTTP
+    async def setup_hook(self):
+        self.http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+    async def close(self):
+        expiry_scheduler.stop()
+        await log_dispatcher.drain()
+        await attachment_archiver.stop()
+        if self.http_session:
+            await self.http_session.close()
+        try:
+            await message_buffer.flush()
+        except Exception as e:
+            print(f"Error flushing message buffer on shutdown: {e}")
+        await super().close()
+bot = MedievalBot(command_prefix=PREFIX, intents=intents, help_command=None, case_insensitive=True)
 tree = bot.tree
+# ---------- OUTBOUND SCHEDULER ----------
+# Strict priority: a queued ban always goes out before a queued reply, announcement or log,
+# and a moderator's own ban goes out before the rest of a running massban
+PRIORITY_ENFORCEMENT, PRIORITY_MASS, PRIORITY_REPLY, PRIORITY_ANNOUNCEMENT, PRIORITY_LOG = range(5)
+PRIORITY_NAMES = {
+    PRIORITY_ENFORCEMENT: "Enforcement",
+    PRIORITY_MASS: "Mass decrees",
+    PRIORITY_REPLY: "Replies",
+    PRIORITY_ANNOUNCEMENT: "Announcements",
+    PRIORITY_LOG: "Chronicles",
+}
+OUTBOUND_CAPS = {
+    PRIORITY_ENFORCEMENT: int(os.getenv("OUTBOUND_ENFORCEMENT_CONCURRENCY", "8")),
+    PRIORITY_MASS: int(os.getenv("OUTBOUND_MASS_CONCURRENCY", "5")),
+    PRIORITY_REPLY: int(os.getenv("OUTBOUND_REPLY_CONCURRENCY", "4")),
+    PRIORITY_ANNOUNCEMENT: int(os.getenv("OUTBOUND_ANNOUNCEMENT_CONCURRENCY", "2")),
+    PRIORITY_LOG: int(os.getenv("OUTBOUND_LOG_CONCURRENCY", "2")),
+}
+# Calls in flight per rate-limit bucket; discord.py already sleeps out 429s, so this only stops one bucket
+# from hogging every slot. Channel and webhook sends stay at one so messages land in order.
+OUTBOUND_BUCKET_CONCURRENCY = int(os.getenv("OUTBOUND_BUCKET_CONCURRENCY", "4"))
+ORDERED_BUCKET_KINDS = ("channel", "webhook")
+class OutboundScheduler:
+    """Priority gate in front of Discord REST calls with per-class concurrency caps"""
+    def __init__(self, caps, bucket_cap=4):
+        self.caps = {priority: max(1, cap) for priority, cap in caps.items()}
+        self.bucket_cap = max(1, bucket_cap)
+        self._queues = {priority: deque() for priority in self.caps}
+        self._in_flight = {priority: 0 for priority in self.caps}
+        self._bucket_in_flight = {} # bucket -> calls running against it
+        self._parked = {} # bucket -> heap of (priority, seq, call, future) waiting on it
+        self._seq = 0
+        self.completed = {priority: 0 for priority in self.caps}
+    async def run(self, priority, bucket, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) behind higher-priority work and await its result"""
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        self._queues[priority].append((self._seq, bucket, partial(func, *args, **kwargs), future))
+        self._pump()
+        return await future
+    def queued(self, priority):
+        return len(self._queues[priority]) + sum(
+            1 for parked in self._parked.values() for entry in parked if entry[0] == priority
+        )
+    def in_flight(self, priority):
+        return self._in_flight[priority]
+    def _bucket_limit(self, bucket):
+        return 1 if bucket[0] in ORDERED_BUCKET_KINDS else self.bucket_cap
+    def _pump(self):
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            while queue and self._in_flight[priority] < self.caps[priority]:
+                seq, bucket, call, future = queue.popleft()
+                if future.cancelled():
+                    continue
+                if bucket is not None and self._bucket_in_flight.get(bucket, 0) >= self._bucket_limit(bucket):
+                    heapq.heappush(self._parked.setdefault(bucket, []), (priority, seq, call, future))
+                    continue
+                self._in_flight[priority] += 1
+                if bucket is not None:
+                    self._bucket_in_flight[bucket] = self._bucket_in_flight.get(bucket, 0) + 1
+                asyncio.get_running_loop().create_task(self._execute(priority, bucket, call, future))
+    async def _execute(self, priority, bucket, call, future):
+        try:
+            result = await call()
+            if not future.done():
+                future.set_result(result)
+        except asyncio.CancelledError:
+            # Shutdown cancelled the call; pass that on so the awaiting caller doesn't hang
+            if not future.done():
+                future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self._in_flight[priority] -= 1
+            self.completed[priority] += 1
+            if bucket is not None:
+                remaining = self._bucket_in_flight.pop(bucket) - 1
+                if remaining:
+                    self._bucket_in_flight[bucket] = remaining
+            parked = self._parked.get(bucket)
+            while parked:
+                # Hand the bucket to its most urgent live waiter, ahead of anything queued since;
+                # a cancelled one would be dropped by _pump and strand everyone parked behind it
+                waiter_priority, seq, waiter_call, waiter_future = heapq.heappop(parked)
+                if not waiter_future.done():
+                    self._queues[waiter_priority].appendleft((seq, bucket, waiter_call, waiter_future))
+                    break
+            if parked is not None and not parked:
+                del self._parked[bucket]
+            self._pump()
+outbound = OutboundScheduler(OUTBOUND_CAPS, bucket_cap=OUTBOUND_BUCKET_CONCURRENCY)
+async def enforce(bucket, func, *args, **kwargs):
+    """Run a moderation API call ahead of all chatter"""
+    return await outbound.run(PRIORITY_ENFORCEMENT, bucket, func, *args, **kwargs)
+async def enforce_in_bulk(func, *args, **kwargs):
+    """Run one strike of a mass action behind single moderation calls but ahead of chatter"""
+    # No bucket: the mass class cap and the caller's own concurrency limit do the pacing,
+    # and discord.py sleeps out any 429 the burst provokes
+    return await outbound.run(PRIORITY_MASS, None, func, *args, **kwargs)
+async def announce(channel, *args, **kwargs):
+    """Post flavour text to a channel once enforcement and replies are served"""
+    return await outbound.run(PRIORITY_ANNOUNCEMENT, ("channel", channel.id), channel.send, *args, **kwargs)
+class RoyalContext(commands.Context):
+    """Command context whose replies wait behind enforcement in the outbound scheduler"""
+    async def send(self, *args, **kwargs):
+        return await outbound.run(PRIORITY_REPLY, ("channel", self.channel.id), super().send, *args, **kwargs)
+# ---------- TIME ----------
+def epoch_ms(when=None):
+    """Milliseconds since the Unix epoch, the unit every stored timestamp uses"""
+    return int((when or utcnow()).timestamp() * 1000)
+def from_epoch_ms(ms):
+    """Aware UTC datetime for a stored timestamp"""
+    return dt.fromtimestamp(ms / 1000, tz=timezone.utc)
+def discord_timestamp(ms, style="R"):
+    """Render a stored timestamp as a Discord <t:...> tag"""
+    return f"<t:{ms // 1000}:{style}>" if ms is not None else "Unknown time"
 # ---------- DATABASE ----------
 def init_db():
     """Initialize database with proper schema and error handling"""
@@ -282,21 +525,20 @@ def init_db():
                 pillory_role INTEGER,
                 bypass_roles TEXT,
                 allowed_roles TEXT,
-                log_channel INTEGER
+                log_channel INTEGER,
+                log_webhook_url TEXT,
+                raid_threshold INTEGER,
+                raid_window INTEGER,
+                raid_action TEXT,
+                spam_action TEXT
             )""")
-            # Check if log_channel column exists, add if not
-            cursor = db.execute("PRAGMA table_info(pillory_config)")
-            columns = [column[1] for column in cursor.fetchall()]
-            if 'log_channel' not in columns:
-                print("Adding missing 'log_channel' column to pillory_config table...")
-                db.execute("ALTER TABLE pillory_config ADD COLUMN log_channel INTEGER")
             db.execute("""
             CREATE TABLE IF NOT EXISTS active_pillories (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 guild_id INTEGER,
                 user_id INTEGER,
-                start_time TEXT,
-                end_time TEXT,
+                start_time INTEGER,
+                end_time INTEGER,
                 reason TEXT,
                 active INTEGER DEFAULT 1
             )""")
@@ -309,7 +551,7 @@ def init_db():
                 target_id INTEGER,
                 action TEXT,
                 reason TEXT,
-                timestamp TEXT
+                timestamp INTEGER
             )""")
             # Warning system
             db.execute("""
@@ -319,7 +561,7 @@ def init_db():
                 user_id INTEGER,
                 moderator_id INTEGER,
                 reason TEXT,
-                timestamp TEXT
+                timestamp INTEGER
             )""")
             # Mute system
             db.execute("""
@@ -328,7 +570,8 @@ def init_db():
                 guild_id INTEGER,
                 user_id INTEGER,
                 moderator_id INTEGER,
-                end_time TEXT,
+                end_time INTEGER,
+                reason TEXT,
                 active INTEGER DEFAULT 1
             )""")
             # Channel locks system
@@ -340,7 +583,7 @@ def init_db():
                 moderator_id INTEGER,
                 reason TEXT,
                 unlock_reason TEXT,
-                timestamp TEXT,
+                timestamp INTEGER,
                 active INTEGER DEFAULT 1
             )""")
             # Message tracking for edits/deletes
@@ -353,13 +596,248 @@ def init_db():
                 user_id INTEGER,
                 content TEXT,
                 attachments TEXT,
-                timestamp TEXT
+                timestamp INTEGER
             )""")
             db.commit()
+            # Bring older databases up to the current schema
+            apply_migrations(db)
+            db.execute("PRAGMA optimize")
             print("✅ Database initialized successfully")
     except sqlite3.Error as e:
         print(f"❌ Database initialization error: {e}")
         raise
+# ---------- SCHEMA MIGRATIONS ----------
+def migrate_add_log_channel(db):
+    """Older databases predate the log_channel column"""
+    columns = [column[1] for column in db.execute("PRAGMA table_info(pillory_config)").fetchall()]
+    if 'log_channel' not in columns:
+        print("Adding missing 'log_channel' column to pillory_config table...")
+        db.execute("ALTER TABLE pillory_config ADD COLUMN log_channel INTEGER")
+HOT_PATH_INDEXES = [
+    # get_message_history: WHERE message_id=? ORDER BY timestamp DESC LIMIT 1
+    "CREATE INDEX IF NOT EXISTS idx_message_history_message ON message_history(message_id, timestamp)",
+    # get_warnings: WHERE guild_id=? AND user_id=? ORDER BY timestamp DESC
+    "CREATE INDEX IF NOT EXISTS idx_warnings_member ON warnings(guild_id, user_id, timestamp)",
+    # is_user_pilloried / get_active_pillories: WHERE guild_id=? [AND user_id=?] AND active=1
+    "CREATE INDEX IF NOT EXISTS idx_active_pillories_member ON active_pillories(guild_id, user_id) WHERE active=1",
+    # get_pillory_expiries: WHERE active=1, only ever touches running sentences
+    "CREATE INDEX IF NOT EXISTS idx_active_pillories_expiry ON active_pillories(end_time) WHERE active=1",
+    # is_channel_locked / get_locked_channels: WHERE guild_id=? [AND channel_id=?] AND active=1
+    "CREATE INDEX IF NOT EXISTS idx_channel_locks_channel ON channel_locks(guild_id, channel_id) WHERE active=1",
+]
+def migrate_hot_path_indexes(db):
+    """Index every lookup the bot makes on its hot paths"""
+    for statement in HOT_PATH_INDEXES:
+        db.execute(statement)
+def migrate_incremental_vacuum(db):
+    """Switch to incremental auto-vacuum so pruned pages can be handed back to the filesystem"""
+    if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("Rebuilding database file for incremental vacuum (one-time, may take a while)...")
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.execute("VACUUM") # auto_vacuum only takes effect on an existing database after a rebuild
+def migrate_retention_indexes(db):
+    """Indexes the retention pruner walks: by age, per guild and per channel"""
+    db.execute("CREATE INDEX IF NOT EXISTS idx_message_history_timestamp ON message_history(timestamp)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_message_history_guild ON message_history(guild_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_message_history_channel ON message_history(channel_id)")
+def migrate_normalized_role_sets(db):
+    """Move the comma-joined bypass/allowed role columns into one row per role"""
+    for table in PILLORY_ROLE_TABLES.values():
+        db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            guild_id INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, role_id)
+        ) WITHOUT ROWID""")
+    rows = db.execute("SELECT guild_id, bypass_roles, allowed_roles FROM pillory_config").fetchall()
+    for guild_id, bypass_roles, allowed_roles in rows:
+        for kind, roles_str in (("bypass", bypass_roles), ("allowed", allowed_roles)):
+            role_ids = {int(r) for r in (roles_str or "").split(',') if r.strip().isdigit()}
+            db.executemany(f"INSERT OR IGNORE INTO {PILLORY_ROLE_TABLES[kind]} (guild_id, role_id) VALUES (?,?)",
+                           [(guild_id, role_id) for role_id in role_ids])
+    # The legacy columns stay in the table but are no longer read
+    db.execute("UPDATE pillory_config SET bypass_roles=NULL, allowed_roles=NULL")
+def migrate_attachments_to_json(db):
+    """Rewrite attachment lists stored as Python reprs into JSON"""
+    # str() of the old list of dicts always starts with the 'url' key in single quotes;
+    # converted rows stop matching, so each batch picks up where the last one ended
+    total = 0
+    while True:
+        rows = db.execute(
+            "SELECT id, attachments FROM message_history WHERE attachments LIKE '[{''url''%' LIMIT 1000"
+        ).fetchall()
+        if not rows:
+            break
+        converted = []
+        for row_id, attachments_str in rows:
+            try:
+                converted.append((encode_attachments(ast.literal_eval(attachments_str)), row_id))
+            except (ValueError, SyntaxError):
+                converted.append((None, row_id)) # Unreadable before, unreadable now; drop it
+        db.executemany("UPDATE message_history SET attachments=? WHERE id=?", converted)
+        total += len(converted)
+    if total:
+        print(f"Converted attachments on {total} stored messages to JSON")
+def migrate_scheduled_jobs(db):
+    """Create the durable job table polled by run_scheduled_jobs"""
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        guild_id INTEGER,
+        target_id INTEGER,
+        run_at INTEGER NOT NULL
+    )""")
+    # claim_due_jobs: WHERE run_at <= ? ORDER BY run_at
+    db.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due ON scheduled_jobs(run_at)")
+    # cancel_jobs: WHERE kind=? AND target_id IN (...)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_target ON scheduled_jobs(kind, target_id)")
+def migrate_tracked_mutes(db):
+    """Give mutes a reason column and the indexes the mute listing and expiry use"""
+    columns = [column[1] for column in db.execute("PRAGMA table_info(mutes)").fetchall()]
+    if 'reason' not in columns:
+        db.execute("ALTER TABLE mutes ADD COLUMN reason TEXT")
+    # get_active_mutes / add_mute: WHERE guild_id=? [AND user_id=?] AND active=1
+    db.execute("CREATE INDEX IF NOT EXISTS idx_mutes_member ON mutes(guild_id, user_id) WHERE active=1")
+    # get_mute_expiries: WHERE active=1
+    db.execute("CREATE INDEX IF NOT EXISTS idx_mutes_expiry ON mutes(end_time) WHERE active=1")
+def migrate_add_log_webhook(db):
+    """Optional per-guild webhook for chronicle delivery"""
+    columns = [column[1] for column in db.execute("PRAGMA table_info(pillory_config)").fetchall()]
+    if 'log_webhook_url' not in columns:
+        db.execute("ALTER TABLE pillory_config ADD COLUMN log_webhook_url TEXT")
+RAID_GUARD_COLUMNS = (("raid_threshold", "INTEGER"), ("raid_window", "INTEGER"), ("raid_action", "TEXT"))
+def migrate_raid_guard(db):
+    """Per-guild join-rate raid detection settings"""
+    columns = [column[1] for column in db.execute("PRAGMA table_info(pillory_config)").fetchall()]
+    for column, column_type in RAID_GUARD_COLUMNS:
+        if column not in columns:
+            db.execute(f"ALTER TABLE pillory_config ADD COLUMN {column} {column_type}")
+def migrate_add_spam_action(db):
+    """Per-guild spam guard response"""
+    columns = [column[1] for column in db.execute("PRAGMA table_info(pillory_config)").fetchall()]
+    if 'spam_action' not in columns:
+        db.execute("ALTER TABLE pillory_config ADD COLUMN spam_action TEXT")
+def migrate_word_filters(db):
+    """Per-guild banned words and phrases"""
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS word_filters (
+        guild_id INTEGER NOT NULL,
+        pattern TEXT NOT NULL,
+        PRIMARY KEY (guild_id, pattern)
+    ) WITHOUT ROWID""")
+def migrate_attachment_archive(db):
+    """Content-addressed files and the attachments that point at them"""
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS archived_files (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        content_type TEXT,
+        stored_at INTEGER NOT NULL
+    ) WITHOUT ROWID""")
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS archived_attachments (
+        attachment_id INTEGER PRIMARY KEY,
+        message_id INTEGER NOT NULL,
+        guild_id INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        archived_at INTEGER NOT NULL
+    )""")
+    # get_archived_attachments: WHERE message_id=?
+    db.execute("CREATE INDEX IF NOT EXISTS idx_archived_attachments_message ON archived_attachments(message_id)")
+    # prune_archived_attachments: WHERE archived_at < ?
+    db.execute("CREATE INDEX IF NOT EXISTS idx_archived_attachments_time ON archived_attachments(archived_at)")
+    # delete_orphaned_files: NOT EXISTS (... WHERE sha256=?)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_archived_attachments_sha ON archived_attachments(sha256)")
+TIMESTAMP_COLUMNS = {
+    "active_pillories": ("start_time", "end_time"),
+    "moderation_logs": ("timestamp",),
+    "warnings": ("timestamp",),
+    "mutes": ("end_time",),
+    "channel_locks": ("timestamp",),
+    "message_history": ("timestamp",),
+}
+def iso_to_epoch_ms_sql(column):
+    # Text that julianday() cannot read becomes NULL; naive ISO strings were always UTC
+    return f"""CASE
+        WHEN {column} IS NULL OR {column} = '' THEN NULL
+        WHEN typeof({column}) = 'integer' THEN {column}
+        ELSE CAST(ROUND((julianday({column}) - 2440587.5) * 86400000.0) AS INTEGER)
+    END"""
+def migrate_epoch_timestamps(db):
+    """Rebuild time columns as INTEGER epoch milliseconds so time ranges filter in SQL"""
+    for table, time_columns in TIMESTAMP_COLUMNS.items():
+        columns = {column[1]: column[2].upper() for column in db.execute(f"PRAGMA table_info({table})").fetchall()}
+        if all(columns.get(column) == "INTEGER" for column in time_columns):
+            continue # Created with the current schema
+        create_sql = db.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0]
+        index_sql = [row[0] for row in db.execute(
+            "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table,)
+        ).fetchall()]
+        sequence = db.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+        new_sql = create_sql.replace(f"CREATE TABLE {table}", f"CREATE TABLE {table}__epoch", 1)
+        for column in time_columns:
+            new_sql = re.sub(rf"\b{column}\s+TEXT\b", f"{column} INTEGER", new_sql)
+        db.execute(new_sql)
+        select_list = ", ".join(iso_to_epoch_ms_sql(c) if c in time_columns else c for c in columns)
+        db.execute(f"INSERT INTO {table}__epoch ({', '.join(columns)}) SELECT {select_list} FROM {table}")
+        db.execute(f"DROP TABLE {table}")
+        db.execute(f"ALTER TABLE {table}__epoch RENAME TO {table}")
+        for statement in index_sql:
+            db.execute(statement)
+        if sequence:
+            # Keep ids that were handed out (pillory numbers) from ever being reused
+            db.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name=?", (sequence[0], table))
+        print(f"Converted {table} timestamps to epoch milliseconds")
+# (version, description, migration, transactional) - append only, never renumber.
+# Non-transactional migrations (VACUUM and friends) must be safe to re-run.
+SCHEMA_MIGRATIONS = [
+    (1, "Add log_channel to pillory_config", migrate_add_log_channel, True),
+    (2, "Indexes for hot-path lookups", migrate_hot_path_indexes, True),
+    (3, "Incremental auto-vacuum", migrate_incremental_vacuum, False),
+    (4, "Indexes for message retention", migrate_retention_indexes, True),
+    (5, "Normalized pillory role sets", migrate_normalized_role_sets, True),
+    (6, "JSON attachment metadata", migrate_attachments_to_json, True),
+    (7, "Epoch millisecond timestamps", migrate_epoch_timestamps, True),
+    (8, "Scheduled jobs", migrate_scheduled_jobs, True),
+    (9, "Tracked mutes", migrate_tracked_mutes, True),
+    (10, "Log webhook", migrate_add_log_webhook, True),
+    (11, "Raid guard settings", migrate_raid_guard, True),
+    (12, "Spam guard setting", migrate_add_spam_action, True),
+    (13, "Word filters", migrate_word_filters, True),
+    (14, "Attachment archive", migrate_attachment_archive, True),
+]
+def get_schema_version(db):
+    """Highest migration applied to this database"""
+    return db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+def apply_migrations(db):
+    """Apply every pending migration in order, each in its own transaction"""
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TEXT
+    )""")
+    current = get_schema_version(db)
+    for version, description, migrate, transactional in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            if not transactional:
+                migrate(db) # Runs outside any transaction (VACUUM), then the version is recorded
+            db.execute("BEGIN IMMEDIATE")
+            if transactional:
+                migrate(db)
+            db.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?,?,?)",
+                       (version, description, utcnow().isoformat()))
+            db.execute("COMMIT")
+        except Exception:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            print(f"❌ Schema migration {version} failed: {description}")
+            raise
+        print(f"✅ Applied schema migration {version}: {description}")
 # ---------- PAGINATED HELP COMMAND ----------
 class HelpView(discord.ui.View):
     def __init__(self, embeds, timeout=60.0):
@@ -386,64 +864,201 @@ class HelpView(discord.ui.View):
     @discord.ui.button(label="🗑️ Close", style=discord.ButtonStyle.red)
     async def close_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.message.delete()
+# ---------- GUILD CONFIG ----------
+@dataclass(frozen=True)
+class GuildConfig:
+    """One guild's pillory_config row, loaded in a single query and kept in memory"""
+    guild_id: int
+    log_channel: Optional[int] = None
+    pillory_channel: Optional[int] = None
+    pillory_role: Optional[int] = None
+    bypass_roles: frozenset = frozenset()
+    allowed_roles: frozenset = frozenset()
+    log_webhook_url: Optional[str] = None
+    raid_threshold: Optional[int] = None # Joins within raid_window seconds that count as a raid; None is off
+    raid_window: Optional[int] = None
+    raid_action: Optional[str] = None
+    spam_action: Optional[str] = None # delete, timeout or pillory; None is off
+    banned_words: frozenset = frozenset()
+GUILD_CONFIG_COLUMNS = ("log_channel", "pillory_channel", "pillory_role", "log_webhook_url",
+                        "raid_threshold", "raid_window", "raid_action", "spam_action")
+PILLORY_ROLE_TABLES = {"bypass": "pillory_bypass_roles", "allowed": "pillory_allowed_roles"}
+guild_configs = {} # guild_id -> GuildConfig; only written on the database thread
+def guild_config_from_row(guild_id, row, bypass_roles=(), allowed_roles=(), banned_words=()):
+    # Empty strings and zero ids have always meant "not set"
+    values = {column: (row[column] or None) for column in GUILD_CONFIG_COLUMNS} if row else {}
+    return GuildConfig(guild_id, bypass_roles=frozenset(bypass_roles), allowed_roles=frozenset(allowed_roles),
+                       banned_words=frozenset(banned_words), **values)
+def load_guild_config(guild_id):
+    """Read one guild's settings and role sets and cache them"""
+    with get_db_reader() as db:
+        row = db.execute(
+            f"SELECT {', '.join(GUILD_CONFIG_COLUMNS)} FROM pillory_config WHERE guild_id=?", (guild_id,)
+        ).fetchone()
+        role_rows = db.execute(f"""
+        SELECT 'bypass', role_id FROM {PILLORY_ROLE_TABLES['bypass']} WHERE guild_id=?
+        UNION ALL
+        SELECT 'allowed', role_id FROM {PILLORY_ROLE_TABLES['allowed']} WHERE guild_id=?
+        """, (guild_id, guild_id)).fetchall()
+        banned_words = [pattern for (pattern,) in db.execute("SELECT pattern FROM word_filters WHERE guild_id=?",
+                                                              (guild_id,))]
+    config = guild_config_from_row(
+        guild_id, row,
+        bypass_roles=[role_id for kind, role_id in role_rows if kind == "bypass"],
+        allowed_roles=[role_id for kind, role_id in role_rows if kind == "allowed"],
+        banned_words=banned_words
+    )
+    guild_configs[guild_id] = config
+    return config
+def load_all_guild_configs():
+    """Warm the cache for every configured guild: one query per table"""
+    role_sets = {kind: {} for kind in PILLORY_ROLE_TABLES}
+    with get_db_reader() as db:
+        rows = db.execute(f"SELECT guild_id, {', '.join(GUILD_CONFIG_COLUMNS)} FROM pillory_config").fetchall()
+        for kind, table in PILLORY_ROLE_TABLES.items():
+            for guild_id, role_id in db.execute(f"SELECT guild_id, role_id FROM {table}"):
+                role_sets[kind].setdefault(guild_id, []).append(role_id)
+        banned_words = {}
+        for guild_id, pattern in db.execute("SELECT guild_id, pattern FROM word_filters"):
+            banned_words.setdefault(guild_id, []).append(pattern)
+    rows_by_guild = {row["guild_id"]: row for row in rows}
+    for guild_id in rows_by_guild.keys() | role_sets["bypass"].keys() | role_sets["allowed"].keys() | banned_words.keys():
+        guild_configs[guild_id] = guild_config_from_row(
+            guild_id, rows_by_guild.get(guild_id),
+            bypass_roles=role_sets["bypass"].get(guild_id, ()),
+            allowed_roles=role_sets["allowed"].get(guild_id, ()),
+            banned_words=banned_words.get(guild_id, ())
+        )
+    return len(guild_configs)
+def update_guild_config(guild_id, column, value):
+    """Upsert one setting and write it through to the cached config"""
+    if column not in GUILD_CONFIG_COLUMNS:
+        raise ValueError(f"Unknown guild setting {column}")
+    with get_db_connection() as db:
+        db.execute(f"""
+        INSERT INTO pillory_config (guild_id, {column}) VALUES (?,?)
+        ON CONFLICT(guild_id) DO UPDATE SET {column}=excluded.{column}
+        """, (guild_id, value))
+    cached = guild_configs.get(guild_id)
+    if cached is not None:
+        guild_configs[guild_id] = replace(cached, **{column: value or None})
+    else:
+        load_guild_config(guild_id) # Keep the cache a complete list of configured guilds
+def replace_pillory_role_set(guild_id, kind, role_ids):
+    """Replace a guild's bypass or allowed roles and write the new frozenset through to the cache"""
+    table = PILLORY_ROLE_TABLES[kind]
+    role_ids = frozenset(role_ids or ())
+    with get_db_connection() as db:
+        db.execute("BEGIN IMMEDIATE")
+        db.execute(f"DELETE FROM {table} WHERE guild_id=?", (guild_id,))
+        db.executemany(f"INSERT INTO {table} (guild_id, role_id) VALUES (?,?)", [(guild_id, r) for r in role_ids])
+        db.execute("COMMIT")
+    cached = guild_configs.get(guild_id)
+    if cached is not None:
+        guild_configs[guild_id] = replace(cached, **{f"{kind}_roles": role_ids})
+def update_word_filters(guild_id, add=(), remove=()):
+    """Add and remove banned patterns and write the new set through to the cache"""
+    with get_db_connection() as db:
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany("INSERT OR IGNORE INTO word_filters (guild_id, pattern) VALUES (?,?)",
+                       [(guild_id, pattern) for pattern in add])
+        db.executemany("DELETE FROM word_filters WHERE guild_id=? AND pattern=?",
+                       [(guild_id, pattern) for pattern in remove])
+        db.execute("COMMIT")
+    cached = guild_configs.get(guild_id)
+    if cached is not None:
+        guild_configs[guild_id] = replace(cached, banned_words=(cached.banned_words | set(add)) - set(remove))
+    else:
+        load_guild_config(guild_id)
+async def get_guild_config(guild_id):
+    """Cached settings for a guild; only the first lookup touches the database"""
+    config = guild_configs.get(guild_id)
+    if config is None:
+        config = await run_db(load_guild_config, guild_id)
+    return config
 # ---------- LOGGING FUNCTIONS ----------
-def get_log_channel(guild_id):
-    """Get the log channel for a guild with proper error handling"""
-    try:
-        with get_db_connection() as db:
-            row = db.execute("SELECT log_channel FROM pillory_config WHERE guild_id=?", (guild_id,)).fetchone()
-            return row[0] if row and row[0] else None
-    except sqlite3.Error as e:
-        print(f"Error getting log channel: {e}")
-        return None
 def set_log_channel(guild_id, channel_id):
-    """Set the log channel for a guild with upsert"""
+    """Set (or clear, with None) the log channel for a guild"""
     try:
-        with get_db_connection() as db:
-            existing = db.execute("SELECT * FROM pillory_config WHERE guild_id=?", (guild_id,)).fetchone()
-            if existing:
-                db.execute("UPDATE pillory_config SET log_channel=? WHERE guild_id=?", (channel_id, guild_id))
-            else:
-                db.execute("INSERT INTO pillory_config (guild_id, log_channel) VALUES (?,?)", (guild_id, channel_id))
-            db.commit()
+        previous = guild_configs.get(guild_id) or load_guild_config(guild_id)
+        update_guild_config(guild_id, "log_channel", channel_id)
+        if previous.log_channel != channel_id:
+            update_guild_config(guild_id, "log_webhook_url", None) # A webhook belongs to the old channel
         print(f"✅ Log channel set to {channel_id} for guild {guild_id}")
     except sqlite3.Error as e:
         print(f"❌ Error setting log channel: {e}")
         raise
-def store_message(message):
-    """Store message content for edit/delete tracking with proper error handling"""
-    if not message.guild or message.author.bot:
-        return
+async def delete_log_webhook(webhook_url, reason):
+    """Remove a chronicle webhook from Discord; one already gone is fine"""
     try:
-        attachments = []
-        if message.attachments:
-            for att in message.attachments:
-                attachments.append({
-                    "url": att.url,
-                    "filename": att.filename,
-                    "size": att.size,
-                    "content_type": getattr(att, 'content_type', None)
-                })
-        with get_db_connection() as db:
-            db.execute("""
-            INSERT INTO message_history (guild_id, channel_id, message_id, user_id, content, attachments, timestamp)
-            VALUES (?,?,?,?,?,?,?)
-            """, (
-                message.guild.id,
-                message.channel.id,
-                message.id,
-                message.author.id,
-                message.content,
-                str(attachments) if attachments else None,
-                utcnow().isoformat()
-            ))
-            db.commit()
-    except Exception as e:
-        print(f"Error storing message: {e}")
+        await discord.Webhook.from_url(webhook_url, session=bot.http_session).delete(reason=reason)
+    except discord.HTTPException:
+        pass
+async def change_log_channel(guild_id, channel_id, reason):
+    """Point the chronicles at a channel, retiring a webhook left behind in the old one"""
+    config = await get_guild_config(guild_id)
+    if config.log_webhook_url and config.log_channel != channel_id:
+        await delete_log_webhook(config.log_webhook_url, reason)
+    await run_db(set_log_channel, guild_id, channel_id)
+def set_raid_guard(guild_id, threshold, window, action):
+    """Set (or clear, with None) a guild's raid detection settings"""
+    try:
+        update_guild_config(guild_id, "raid_threshold", threshold)
+        update_guild_config(guild_id, "raid_window", window)
+        update_guild_config(guild_id, "raid_action", action)
+        print(f"✅ Raid guard {'armed' if threshold else 'disarmed'} for guild {guild_id}")
+    except sqlite3.Error as e:
+        print(f"❌ Error setting raid guard: {e}")
+        raise
+def set_spam_action(guild_id, action):
+    """Set (or clear, with None) how a guild answers spam"""
+    try:
+        update_guild_config(guild_id, "spam_action", action)
+        print(f"✅ Spam guard set to {action or 'off'} for guild {guild_id}")
+    except sqlite3.Error as e:
+        print(f"❌ Error setting spam guard: {e}")
+        raise
+def set_log_webhook(guild_id, webhook_url):
+    """Set (or clear, with None) the webhook chronicle entries are delivered through"""
+    try:
+        update_guild_config(guild_id, "log_webhook_url", webhook_url)
+        print(f"✅ Log webhook {'enabled' if webhook_url else 'disabled'} for guild {guild_id}")
+    except sqlite3.Error as e:
+        print(f"❌ Error setting log webhook: {e}")
+        raise
+def message_history_row(message):
+    """Snapshot the fields of a message that are kept for edit/delete tracking"""
+    attachments = []
+    if message.attachments:
+        for att in message.attachments:
+            attachments.append({
+                "url": att.url,
+                "filename": att.filename,
+                "size": att.size,
+                "content_type": getattr(att, 'content_type', None)
+            })
+    return (
+        message.guild.id,
+        message.channel.id,
+        message.id,
+        message.author.id,
+        message.content,
+        encode_attachments(attachments),
+        epoch_ms()
+    )
+def insert_message_history(rows):
+    """Write a batch of message snapshots to the history table in a single transaction"""
+    with get_db_connection() as db:
+        db.execute("BEGIN")
+        db.executemany("""
+        INSERT INTO message_history (guild_id, channel_id, message_id, user_id, content, attachments, timestamp)
+        VALUES (?,?,?,?,?,?,?)
+        """, rows)
+        db.execute("COMMIT")
 def get_message_history(message_id):
     """Get stored message data"""
     try:
-        with get_db_connection() as db:
+        with get_db_reader() as db:
             row = db.execute("""
             SELECT content, attachments, user_id FROM message_history
             WHERE message_id=? ORDER BY timestamp DESC LIMIT 1
@@ -452,28 +1067,39 @@ def get_message_history(message_id):
     except Exception as e:
         print(f"Error getting message history: {e}")
         return None
+def encode_attachments(attachments):
+    """Compact JSON for the attachments column (None when there are none)"""
+    return json.dumps(attachments, separators=(",", ":")) if attachments else None
+def decode_attachments(attachments_str):
+    """Parse the attachments column back into a list of dicts"""
+    return json.loads(attachments_str) if attachments_str else []
 def format_attachments(attachments_str):
     """Format attachment data for display"""
     if not attachments_str:
         return ""
     try:
-        attachments = ast.literal_eval(attachments_str)
+        attachments = decode_attachments(attachments_str)
         if attachments:
             files = []
             for att in attachments:
                 size_kb = att['size'] / 1024 if att.get('size') else 0
-                content_type = att.get('content_type', '')
+                content_type = att.get('content_type') or ''
                 emoji = "🖼️" if any(img in content_type.lower() for img in ['image', 'photo', 'jpeg', 'png', 'gif']) else "📎"
                 files.append(f"{emoji} `{att['filename']}` ({size_kb:.1f}KB)")
             return "\n".join(files)
     except Exception as e:
         print(f"Error formatting attachments: {e}")
     return ""
-async def send_log_embed(guild, embed_type, title, description, fields=None, color="blue", thumbnail=None):
+async def send_log_embed(guild, embed_type, title, description, fields=None, color="blue", thumbnail=None, files=None):
     """Send log embed to configured channel with enhanced validation"""
     if not guild:
         return False
-    log_channel_id = get_log_channel(guild.id)
+    try:
+        config = await get_guild_config(guild.id)
+        log_channel_id = config.log_channel
+    except Exception as e:
+        print(f"Error getting log channel: {e}")
+        return False
     if not log_channel_id:
         return False
     log_channel = guild.get_channel(log_channel_id)
@@ -481,9 +1107,7 @@ async def send_log_embed(guild, embed_type, title, description, fields=None, col
         print(f"❌ Log channel {log_channel_id} not found in guild {guild.id}")
         # Try to remove invalid channel from database
         try:
-            with get_db_connection() as db:
-                db.execute("UPDATE pillory_config SET log_channel=NULL WHERE guild_id=?", (guild.id,))
-                db.commit()
+            await run_db(set_log_channel, guild.id, None)
         except:
             pass
         return False
@@ -495,142 +1119,682 @@ async def send_log_embed(guild, embed_type, title, description, fields=None, col
         if thumbnail:
             embed.set_thumbnail(url=thumbnail)
         embed.set_footer(text=f"Server: {guild.name} | ID: {guild.id}")
-        await log_channel.send(embed=embed)
-        return True
-    except discord.Forbidden:
-        print(f"❌ No permission to send logs to channel {log_channel_id}")
-        return False
+        return log_dispatcher.enqueue(log_channel, embed, webhook_url=config.log_webhook_url, files=files)
     except Exception as e:
         print(f"❌ Error sending log: {e}")
         return False
-# ---------- PILLORY FUNCTIONS ----------
-def get_pillory_channel(guild_id):
-    """Get the pillory channel for a guild"""
+# ---------- LOG DELIVERY ----------
+LOG_BATCH_WINDOW_MS = int(os.getenv("LOG_BATCH_WINDOW_MS", "750"))
+LOG_QUEUE_LIMIT = int(os.getenv("LOG_QUEUE_LIMIT", "500")) # Pending embeds per log channel
+LOG_OVERFLOW_POLICY = os.getenv("LOG_OVERFLOW_POLICY", "drop_oldest") # or drop_newest
+EMBEDS_PER_MESSAGE = 10 # Discord caps a message at 10 embeds...
+EMBED_CHARS_PER_MESSAGE = 6000 # ...and 6000 characters across all of them
+LOG_WEBHOOK_NAME = "Royal Chronicle"
+class LogDispatcher:
+    """Per-channel log queues that pack bursts of embeds into as few messages as Discord allows"""
+    def __init__(self, window_ms=750, max_pending=500, overflow="drop_oldest"):
+        self.window = window_ms / 1000
+        self.max_pending = max(1, max_pending)
+        self.drop_newest = overflow == "drop_newest"
+        self._queues = {} # channel_id -> deque of (embed, files)
+        self._channels = {}
+        self._webhook_urls = {}
+        self._workers = {}
+        self.messages_sent = 0
+        self.webhook_messages = 0
+        self.embeds_sent = 0
+        self.dropped = 0
+        self.failed = 0
+    def enqueue(self, channel, embed, webhook_url=None, files=None):
+        """Queue an embed for a log channel and return at once; False if the overflow policy shed it"""
+        queue = self._queues.setdefault(channel.id, deque())
+        self._channels[channel.id] = channel
+        self._webhook_urls[channel.id] = webhook_url
+        if len(queue) >= self.max_pending:
+            self.dropped += 1
+            if self.drop_newest:
+                return False
+            queue.popleft()
+        queue.append((embed, files))
+        worker = self._workers.get(channel.id)
+        if worker is None or worker.done():
+            self._workers[channel.id] = asyncio.get_running_loop().create_task(self._drain(channel.id))
+        return True
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+    @staticmethod
+    def _take_batch(queue):
+        batch = []
+        chars = 0
+        while queue and len(batch) < EMBEDS_PER_MESSAGE:
+            embed, files = queue[0]
+            if files:
+                # An entry with uploads goes out on its own so its files stay beside it
+                if batch:
+                    break
+                queue.popleft()
+                return [embed], files
+            size = len(embed) # Embed.__len__ counts every character Discord counts
+            if batch and chars + size > EMBED_CHARS_PER_MESSAGE:
+                break
+            batch.append(queue.popleft()[0])
+            chars += size
+        return batch, None
+    async def _drain(self, channel_id):
+        queue = self._queues[channel_id]
+        while queue:
+            if len(queue) < EMBEDS_PER_MESSAGE:
+                await asyncio.sleep(self.window) # Give the rest of a burst a moment to arrive
+            batch, files = self._take_batch(queue)
+            if not batch:
+                continue
+            try:
+                await self._deliver(channel_id, batch, files)
+                self.messages_sent += 1
+                self.embeds_sent += len(batch)
+            except discord.Forbidden:
+                self.failed += len(batch)
+                print(f"❌ No permission to send logs to channel {channel_id}")
+            except Exception as e:
+                self.failed += len(batch)
+                print(f"❌ Error sending log: {e}")
+    @staticmethod
+    def _open_files(files):
+        # Fresh handles per attempt: a send closes its files, so a webhook failure can't hand them to the fallback
+        if not files:
+            return {}
+        return {"files": [discord.File(path, filename=filename) for path, filename in files if os.path.exists(path)]}
+    async def _deliver(self, channel_id, batch, files=None):
+        channel = self._channels[channel_id]
+        webhook_url = self._webhook_urls.get(channel_id)
+        if webhook_url:
+            try:
+                webhook = discord.Webhook.from_url(webhook_url, session=bot.http_session)
+                await outbound.run(PRIORITY_LOG, ("webhook", webhook.id), webhook.send,
+                                   embeds=batch, username=LOG_WEBHOOK_NAME, **self._open_files(files))
+                self.webhook_messages += 1
+                return
+            except (discord.NotFound, discord.Forbidden):
+                # Deleted or revoked from Discord's side; forget it and carry on as the bot
+                self._webhook_urls[channel_id] = None
+                print(f"❌ Chronicle webhook for channel {channel_id} is gone; falling back to the bot")
+                try:
+                    await run_db(set_log_webhook, channel.guild.id, None)
+                except Exception:
+                    pass
+            except discord.HTTPException as e:
+                print(f"❌ Chronicle webhook failed, sending as the bot: {e}")
+        await outbound.run(PRIORITY_LOG, ("channel", channel_id), channel.send, embeds=batch, **self._open_files(files))
+    async def drain(self, timeout=5):
+        """Wait for queued logs to go out, used on shutdown"""
+        workers = [worker for worker in self._workers.values() if not worker.done()]
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+log_dispatcher = LogDispatcher(window_ms=LOG_BATCH_WINDOW_MS, max_pending=LOG_QUEUE_LIMIT, overflow=LOG_OVERFLOW_POLICY)
+LOG_FANOUT_CONCURRENCY = int(os.getenv("LOG_FANOUT_CONCURRENCY", "16"))
+def logged_guild_members(user_id):
+    """(guild, member) for each guild with a chronicle channel that the user belongs to"""
+    # Only guilds with a log channel can produce output, so walk those instead of every guild
+    for config in list(guild_configs.values()):
+        if not config.log_channel:
+            continue
+        guild = bot.get_guild(config.guild_id)
+        member = guild.get_member(user_id) if guild else None
+        if member:
+            yield guild, member
+async def gather_bounded(coros, limit=LOG_FANOUT_CONCURRENCY):
+    """Await coroutines concurrently with at most `limit` running; exceptions are returned, not raised"""
+    if not coros:
+        return []
+    gate = asyncio.Semaphore(max(1, limit))
+    async def bounded(coro):
+        async with gate:
+            return await coro
+    return await asyncio.gather(*(bounded(coro) for coro in coros), return_exceptions=True)
+ROLE_LOG_DEBOUNCE_SECONDS = float(os.getenv("ROLE_LOG_DEBOUNCE_SECONDS", "0")) # 0 logs each update as it comes
+pending_role_changes = {} # (guild_id, member_id) -> (added role ids, removed role ids) awaiting the debounce window
+def role_list_value(roles, limit=1024):
+    """Mentions for an embed field, trimmed to Discord's field length"""
+    value = ""
+    for shown, role in enumerate(roles):
+        mention = role.mention if hasattr(role, "mention") else f"`{role}` (deleted)"
+        if len(value) + len(mention) + 30 > limit:
+            return value + f"...and {len(roles) - shown} more"
+        value += mention + "\n"
+    return value or "None"
+async def log_role_changes(member, added_ids, removed_ids):
+    """Chronicle every role a member gained and lost in a single entry"""
+    guild = member.guild
+    added = sorted((guild.get_role(role_id) or role_id for role_id in added_ids),
+                   key=lambda role: getattr(role, "position", 0), reverse=True)
+    removed = sorted((guild.get_role(role_id) or role_id for role_id in removed_ids),
+                     key=lambda role: getattr(role, "position", 0), reverse=True)
+    fields = [("👤 Member", f"{member.mention} (`{member.id}`)", False)]
+    if added:
+        fields.append(("⚔️ Bestowed", role_list_value(added), True))
+    if removed:
+        fields.append(("🗡️ Stripped", role_list_value(removed), True))
+    if len(added) + len(removed) == 1:
+        embed_type = "role_add" if added else "role_remove"
+        role = (added or removed)[0]
+        description = random.choice(LOG_MESSAGES[embed_type]).format(
+            user=member.mention,
+            role=role.mention if hasattr(role, "mention") else f"`{role}`"
+        )
+        if hasattr(role, "color"):
+            fields.append(("📊 Color", f"#{role.color.value:06x}" if role.color.value else "None", True))
+    else:
+        embed_type = "role_change"
+        description = f"{member.mention}'s honors have changed: **{len(added)}** bestowed, **{len(removed)}** stripped!"
+    if added and removed:
+        title, color = "⚖️ Honors Reshuffled", "yellow"
+    elif added:
+        title, color = "⚔️ Honor Bestowed", "green"
+    else:
+        title, color = "🗡️ Honor Stripped", "red"
+    await send_log_embed(
+        guild,
+        embed_type,
+        title,
+        description,
+        fields=fields,
+        color=color,
+        thumbnail=str(member.avatar.url) if member.avatar else None
+    )
+async def queue_role_change_log(member, added_ids, removed_ids):
+    """Log a role diff now, or fold it into the member's pending entry when debouncing"""
+    if ROLE_LOG_DEBOUNCE_SECONDS <= 0:
+        return await log_role_changes(member, added_ids, removed_ids)
+    key = (member.guild.id, member.id)
+    pending = pending_role_changes.get(key)
+    if pending is None:
+        pending_role_changes[key] = (set(added_ids), set(removed_ids))
+        asyncio.get_running_loop().create_task(flush_role_change_log(member.guild, member.id))
+        return
+    added, removed = pending
+    # A role given and taken back inside the window nets out to nothing
+    added |= added_ids - removed
+    removed -= added_ids
+    removed |= removed_ids - added
+    added -= removed_ids
+async def flush_role_change_log(guild, member_id):
+    await asyncio.sleep(ROLE_LOG_DEBOUNCE_SECONDS)
+    added, removed = pending_role_changes.pop((guild.id, member_id), (set(), set()))
+    member = guild.get_member(member_id)
+    if member and (added or removed):
+        try:
+            await log_role_changes(member, added, removed)
+        except Exception as e:
+            print(f"Error logging role changes: {e}")
+# ---------- MESSAGE INGESTION ----------
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MESSAGE_FLUSH_MS = int(os.getenv("MESSAGE_FLUSH_MS", "500"))
+MESSAGE_BUFFER_LIMIT = int(os.getenv("MESSAGE_BUFFER_LIMIT", "20000"))
+class MessageWriteBuffer:
+    """Write-behind queue that group-commits message_history rows"""
+    def __init__(self, batch_size=200, max_rows=20000):
+        self.batch_size = max(1, batch_size)
+        self.max_rows = max(self.batch_size, max_rows)
+        self._rows = []
+        self._unflushed = {} # message_id -> newest row not yet committed
+        self._flush_task = None
+        self.dropped = 0
+    def add(self, row):
+        """Queue a row; a flush starts as soon as a full batch is waiting"""
+        self._rows.append(row)
+        self._unflushed[row[2]] = row
+        if len(self._rows) > self.max_rows:
+            # The database has been unreachable for a while; shed the oldest rows rather than grow forever
+            overflow = len(self._rows) - self.max_rows
+            for old in self._rows[:overflow]:
+                if self._unflushed.get(old[2]) is old:
+                    del self._unflushed[old[2]]
+            del self._rows[:overflow]
+            self.dropped += overflow
+        if len(self._rows) >= self.batch_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+    def get(self, message_id):
+        """Return the newest unflushed snapshot for a message, if any"""
+        return self._unflushed.get(message_id)
+    def __len__(self):
+        return len(self._rows)
+    def _take(self):
+        rows, self._rows = self._rows, []
+        return rows
+    def _committed(self, rows):
+        for row in rows:
+            if self._unflushed.get(row[2]) is row:
+                del self._unflushed[row[2]]
+    def _settle(self, rows, ok):
+        if ok:
+            self._committed(rows)
+        else:
+            self._rows[:0] = rows # Put the batch back so the next flush retries it
+    def _insert(self, rows, claim, loop):
+        """Runs on the database thread; once started, the batch reports its own outcome back to the loop"""
+        with claim["lock"]:
+            if claim["abandoned"]:
+                return False # The flush gave up before we ran and has already requeued the rows
+            claim["started"] = True
+        try:
+            insert_message_history(rows)
+            ok = True
+        except Exception as e:
+            print(f"Error flushing message history: {e}")
+            ok = False
+        try:
+            loop.call_soon_threadsafe(self._settle, rows, ok)
+        except RuntimeError:
+            pass # Loop already closed on shutdown
+        return ok
+    async def flush(self):
+        """Write every queued row in one transaction on the database thread"""
+        rows = self._take()
+        if not rows:
+            return 0
+        claim = {"lock": Lock(), "started": False, "abandoned": False}
+        try:
+            ok = await run_db(self._insert, rows, claim, asyncio.get_running_loop())
+        except BaseException as e:
+            # A timeout or cancel doesn't stop a batch the database thread already began; requeueing
+            # that one would insert it twice, so only take back a batch that never started
+            with claim["lock"]:
+                claim["abandoned"] = True
+                started = claim["started"]
+            if not started:
+                self._rows[:0] = rows
+            if not isinstance(e, Exception):
+                raise
+            print(f"Error flushing message history: {e}")
+            return 0
+        return len(rows) if ok else 0
+    def flush_sync(self):
+        """Write any leftover rows directly; only used once the event loop has stopped"""
+        rows = self._take()
+        if rows:
+            insert_message_history(rows)
+            self._committed(rows)
+        return len(rows)
+message_buffer = MessageWriteBuffer(batch_size=MESSAGE_BATCH_SIZE, max_rows=MESSAGE_BUFFER_LIMIT)
+# ---------- MESSAGE CACHE ----------
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "50000"))
+MESSAGE_CACHE_MAX_MB = float(os.getenv("MESSAGE_CACHE_MAX_MB", "64"))
+class MessageCache:
+    """Bounded LRU of recent message snapshots, capped by entry count and approximate memory"""
+    ENTRY_OVERHEAD = 200 # Rough bytes per entry for the key, tuple and dict slot
+    def __init__(self, max_entries=50000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # message_id -> (content, attachments, user_id)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def _size(self, snapshot):
+        return self.ENTRY_OVERHEAD + len(snapshot[0] or "") + len(snapshot[1] or "")
+    def put(self, message_id, snapshot):
+        """Remember the newest snapshot of a message and evict the least recently used ones"""
+        old = self._entries.pop(message_id, None)
+        if old is not None:
+            self.bytes -= self._size(old)
+        self._entries[message_id] = snapshot
+        self.bytes += self._size(snapshot)
+        while len(self._entries) > self.max_entries or (self.bytes > self.max_bytes and len(self._entries) > 1):
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= self._size(evicted)
+            self.evictions += 1
+    def get(self, message_id):
+        """O(1) lookup that counts hits and misses"""
+        snapshot = self._entries.get(message_id)
+        if snapshot is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(message_id)
+        self.hits += 1
+        return snapshot
+    def discard(self, message_id):
+        snapshot = self._entries.pop(message_id, None)
+        if snapshot is not None:
+            self.bytes -= self._size(snapshot)
+    def __len__(self):
+        return len(self._entries)
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+message_cache = MessageCache(max_entries=MESSAGE_CACHE_SIZE, max_bytes=int(MESSAGE_CACHE_MAX_MB * 1024 * 1024))
+def store_message(message):
+    """Store message content for edit/delete tracking with proper error handling"""
+    if not message.guild or message.author.bot:
+        return
     try:
-        with get_db_connection() as db:
-            row = db.execute("SELECT pillory_channel FROM pillory_config WHERE guild_id=?", (guild_id,)).fetchone()
-            return row[0] if row and row[0] else None
-    except sqlite3.Error as e:
-        print(f"Error getting pillory channel: {e}")
+        # Snapshot on the event loop; the buffer commits it with the rest of its batch
+        row = message_history_row(message)
+        message_buffer.add(row)
+        message_cache.put(row[2], (row[4], row[5], row[3]))
+    except Exception as e:
+        print(f"Error storing message: {e}")
+async def lookup_message_history(message_id):
+    """Get stored message data from the cache, the unflushed buffer, then the database"""
+    snapshot = message_cache.get(message_id)
+    if snapshot:
+        return snapshot
+    row = message_buffer.get(message_id)
+    if row:
+        return (row[4], row[5], row[3])
+    try:
+        row = await run_db(get_message_history, message_id)
+    except Exception as e:
+        print(f"Error getting message history: {e}")
         return None
+    if row:
+        snapshot = (row[0], row[1], row[2])
+        message_cache.put(message_id, snapshot)
+        return snapshot
+    return None
+# ---------- MESSAGE RETENTION ----------
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "30")) # 0 keeps messages forever
+MESSAGE_CAP_PER_GUILD = int(os.getenv("MESSAGE_CAP_PER_GUILD", "0")) # 0 means no cap
+MESSAGE_CAP_PER_CHANNEL = int(os.getenv("MESSAGE_CAP_PER_CHANNEL", "0"))
+PRUNE_INTERVAL_MINUTES = int(os.getenv("PRUNE_INTERVAL_MINUTES", "15"))
+PRUNE_BATCH_SIZE = int(os.getenv("PRUNE_BATCH_SIZE", "500"))
+PRUNE_BATCH_PAUSE = float(os.getenv("PRUNE_BATCH_PAUSE", "0.05")) # Seconds the write lock is left free between batches
+VACUUM_BATCH_PAGES = int(os.getenv("VACUUM_BATCH_PAGES", "1000"))
+MESSAGE_SCOPE_COLUMNS = ("guild_id", "channel_id")
+def prune_messages_before(cutoff, limit):
+    """Delete up to limit messages stored before cutoff; returns how many went"""
+    with get_db_connection() as db:
+        return db.execute("""
+        DELETE FROM message_history WHERE id IN (
+            SELECT id FROM message_history WHERE timestamp < ? LIMIT ?
+        )""", (cutoff, limit)).rowcount
+def get_message_scopes_over_cap(column, cap):
+    """Find guilds or channels holding more than cap messages"""
+    if column not in MESSAGE_SCOPE_COLUMNS:
+        raise ValueError(f"Unknown message scope {column}")
+    with get_db_reader() as db:
+        return [row[0] for row in db.execute(
+            f"SELECT {column} FROM message_history GROUP BY {column} HAVING COUNT(*) > ?", (cap,)
+        ).fetchall()]
+def prune_messages_over_cap(column, scope_id, cap, limit):
+    """Delete up to limit of the oldest messages beyond the newest cap in one guild or channel"""
+    if column not in MESSAGE_SCOPE_COLUMNS:
+        raise ValueError(f"Unknown message scope {column}")
+    with get_db_connection() as db:
+        row = db.execute(
+            f"SELECT id FROM message_history WHERE {column}=? ORDER BY id DESC LIMIT 1 OFFSET ?", (scope_id, cap)
+        ).fetchone()
+        if not row:
+            return 0
+        return db.execute(f"""
+        DELETE FROM message_history WHERE id IN (
+            SELECT id FROM message_history WHERE {column}=? AND id<=? ORDER BY id LIMIT ?
+        )""", (scope_id, row[0], limit)).rowcount
+def incremental_vacuum(pages):
+    """Return up to pages free pages to the filesystem; reports how many are still free"""
+    with get_db_connection() as db:
+        # execute() steps the pragma only once, freeing a single page; executescript runs it to completion
+        db.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        return db.execute("PRAGMA freelist_count").fetchone()[0]
+async def prune_in_batches(func, *args):
+    """Repeat a batched delete until it comes up short, yielding the write lock between batches"""
+    total = 0
+    while True:
+        deleted = await run_db(func, *args, PRUNE_BATCH_SIZE)
+        total += deleted
+        if deleted < PRUNE_BATCH_SIZE:
+            return total
+        await asyncio.sleep(PRUNE_BATCH_PAUSE)
+async def prune_message_history_once():
+    """Apply every retention rule once, then reclaim the freed pages"""
+    removed = 0
+    if MESSAGE_RETENTION_DAYS > 0:
+        cutoff = epoch_ms(utcnow() - timedelta(days=MESSAGE_RETENTION_DAYS))
+        removed += await prune_in_batches(prune_messages_before, cutoff)
+    for column, cap in (("guild_id", MESSAGE_CAP_PER_GUILD), ("channel_id", MESSAGE_CAP_PER_CHANNEL)):
+        if cap <= 0:
+            continue
+        for scope_id in await run_db(get_message_scopes_over_cap, column, cap):
+            removed += await prune_in_batches(prune_messages_over_cap, column, scope_id, cap)
+    if removed:
+        while await run_db(incremental_vacuum, VACUUM_BATCH_PAGES):
+            await asyncio.sleep(PRUNE_BATCH_PAUSE)
+    return removed
+# ---------- ATTACHMENT ARCHIVE ----------
+ATTACHMENT_ARCHIVE_DIR = os.getenv("ATTACHMENT_ARCHIVE_DIR", "") # Empty leaves the archive off
+ATTACHMENT_ARCHIVE_MAX_MB = float(os.getenv("ATTACHMENT_ARCHIVE_MAX_MB", "8")) # Larger attachments are skipped
+ATTACHMENT_ARCHIVE_TYPES = tuple(
+    prefix.strip().lower()
+    for prefix in os.getenv("ATTACHMENT_ARCHIVE_TYPES", "image/,video/,audio/,text/plain,application/pdf").split(",")
+    if prefix.strip()
+) # Content-type prefixes worth keeping
+ATTACHMENT_ARCHIVE_DAYS = int(os.getenv("ATTACHMENT_ARCHIVE_DAYS", str(MESSAGE_RETENTION_DAYS))) # 0 keeps files forever
+ATTACHMENT_ARCHIVE_QUEUE = int(os.getenv("ATTACHMENT_ARCHIVE_QUEUE", "500")) # Pending messages before new ones are dropped
+ATTACHMENT_ARCHIVE_CONCURRENCY = int(os.getenv("ATTACHMENT_ARCHIVE_CONCURRENCY", "2"))
+ATTACHMENT_ARCHIVE_WAIT_SECONDS = float(os.getenv("ATTACHMENT_ARCHIVE_WAIT_SECONDS", "5")) # Delete logs wait this long on an in-flight download
+ARCHIVE_CHUNK_BYTES = 64 * 1024
+def record_archived_attachment(attachment_id, message_id, guild_id, filename, sha256, size, content_type):
+    """Point an attachment at its stored file, recording the file itself the first time it is seen"""
+    now = epoch_ms()
+    with get_db_connection() as db:
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("""
+        INSERT OR IGNORE INTO archived_files (sha256, size, content_type, stored_at) VALUES (?,?,?,?)
+        """, (sha256, size, content_type, now))
+        db.execute("""
+        INSERT OR REPLACE INTO archived_attachments (attachment_id, message_id, guild_id, sha256, filename, archived_at)
+        VALUES (?,?,?,?,?,?)
+        """, (attachment_id, message_id, guild_id, sha256, filename, now))
+        db.execute("COMMIT")
+def get_archived_attachments(message_id):
+    """(sha256, filename, size) for each archived attachment of a message"""
+    with get_db_reader() as db:
+        return db.execute("""
+        SELECT a.sha256, a.filename, f.size FROM archived_attachments a
+        JOIN archived_files f ON f.sha256 = a.sha256
+        WHERE a.message_id=? ORDER BY a.attachment_id
+        """, (message_id,)).fetchall()
+def prune_archived_attachments(cutoff, limit):
+    """Forget up to limit attachments archived before cutoff; their files go once nothing points at them"""
+    with get_db_connection() as db:
+        return db.execute("""
+        DELETE FROM archived_attachments WHERE attachment_id IN (
+            SELECT attachment_id FROM archived_attachments WHERE archived_at < ? LIMIT ?
+        )""", (cutoff, limit)).rowcount
+def delete_orphaned_files(limit, path_for):
+    """Delete up to limit files no attachment refers to, rows and blobs together; returns how many went"""
+    with get_db_connection() as db:
+        db.execute("BEGIN IMMEDIATE")
+        orphans = [row[0] for row in db.execute("""
+        SELECT sha256 FROM archived_files f
+        WHERE NOT EXISTS (SELECT 1 FROM archived_attachments a WHERE a.sha256 = f.sha256) LIMIT ?
+        """, (limit,)).fetchall()]
+        db.executemany("DELETE FROM archived_files WHERE sha256=?", [(sha256,) for sha256 in orphans])
+        # Unlink before COMMIT: the write lock keeps an archiver from adopting a blob that is about to vanish
+        for sha256 in orphans:
+            try:
+                os.remove(path_for(sha256))
+            except FileNotFoundError:
+                pass
+        db.execute("COMMIT")
+        return len(orphans)
+class AttachmentArchiver:
+    """Background downloads of attachments into a content-addressed store, so deleted evidence survives"""
+    def __init__(self, root, max_bytes, content_types, max_pending=500, concurrency=2):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.content_types = content_types
+        self.max_pending = max(1, max_pending)
+        self.concurrency = max(1, concurrency)
+        self._queue = None # Created on first use, inside the running loop
+        self._workers = []
+        self._pending = {} # message_id -> Event set once its attachments are handled
+        self.stored = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.failed = 0
+    @property
+    def enabled(self):
+        return bool(self.root)
+    def __len__(self):
+        return self._queue.qsize() if self._queue else 0
+    def path(self, sha256):
+        # Fan out by the first byte so no single directory grows unbounded
+        return os.path.join(self.root, sha256[:2], sha256)
+    def wants(self, attachment):
+        content_type = (attachment.content_type or "").lower()
+        return attachment.size <= self.max_bytes and content_type.startswith(self.content_types)
+    def submit(self, message):
+        """Queue a message's attachments for download and return at once"""
+        if not self.enabled or not message.attachments:
+            return
+        wanted = [attachment for attachment in message.attachments if self.wants(attachment)]
+        self.skipped += len(message.attachments) - len(wanted)
+        if not wanted:
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            loop = asyncio.get_running_loop()
+            self._workers = [loop.create_task(self._work()) for _ in range(self.concurrency)]
+        try:
+            self._queue.put_nowait((message.guild.id, message.id, wanted))
+        except asyncio.QueueFull:
+            self.dropped += len(wanted)
+            return
+        self._pending[message.id] = asyncio.Event()
+    async def _work(self):
+        while True:
+            guild_id, message_id, attachments = await self._queue.get()
+            try:
+                for attachment in attachments:
+                    try:
+                        await self._archive(guild_id, message_id, attachment)
+                    except Exception as e:
+                        self.failed += 1
+                        print(f"❌ Error archiving attachment {attachment.id}: {e}")
+            finally:
+                done = self._pending.pop(message_id, None)
+                if done:
+                    done.set()
+                self._queue.task_done()
+    async def _archive(self, guild_id, message_id, attachment):
+        # Hash while streaming; the size cap is enforced on the bytes received, not the size Discord reported
+        digest = hashlib.sha256()
+        payload = BytesIO()
+        async with bot.http_session.get(attachment.url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(ARCHIVE_CHUNK_BYTES):
+                if payload.tell() + len(chunk) > self.max_bytes:
+                    self.skipped += 1
+                    return
+                digest.update(chunk)
+                payload.write(chunk)
+        sha256 = digest.hexdigest()
+        # Claim the hash before trusting a blob already on disk, so the orphan prune can't delete it underneath us
+        await run_db(record_archived_attachment, attachment.id, message_id, guild_id, attachment.filename,
+                     sha256, payload.tell(), attachment.content_type)
+        if await asyncio.to_thread(self._store, sha256, payload.getvalue()):
+            self.stored += 1
+        else:
+            self.duplicates += 1
+    def _store(self, sha256, data):
+        """Write a blob under its hash unless it is already there; True when a new file was written"""
+        path = self.path(sha256)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write beside the target and rename, so a crash never leaves a truncated file under a valid hash
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+        return True
+    async def stop(self):
+        """Cancel the download workers, used on shutdown before the HTTP session closes"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+    async def evidence(self, message_id, limit_bytes):
+        """(path, filename) pairs for a message's archived files that fit in one upload"""
+        if not self.enabled:
+            return []
+        done = self._pending.get(message_id)
+        if done:
+            try:
+                await asyncio.wait_for(done.wait(), ATTACHMENT_ARCHIVE_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        files = []
+        total = 0
+        for sha256, filename, size in await run_db(get_archived_attachments, message_id):
+            if len(files) >= EMBEDS_PER_MESSAGE or total + size > limit_bytes:
+                break
+            files.append((self.path(sha256), filename))
+            total += size
+        return files
+attachment_archiver = AttachmentArchiver(
+    ATTACHMENT_ARCHIVE_DIR,
+    max_bytes=int(ATTACHMENT_ARCHIVE_MAX_MB * 1024 * 1024),
+    content_types=ATTACHMENT_ARCHIVE_TYPES,
+    max_pending=ATTACHMENT_ARCHIVE_QUEUE,
+    concurrency=ATTACHMENT_ARCHIVE_CONCURRENCY
+)
+async def prune_attachment_archive_once():
+    """Forget attachments past retention and delete files nothing points at any more; returns files deleted"""
+    if not attachment_archiver.enabled or ATTACHMENT_ARCHIVE_DAYS <= 0:
+        return 0
+    cutoff = epoch_ms(utcnow() - timedelta(days=ATTACHMENT_ARCHIVE_DAYS))
+    await prune_in_batches(prune_archived_attachments, cutoff)
+    deleted = 0
+    while True:
+        removed = await run_db(delete_orphaned_files, PRUNE_BATCH_SIZE, attachment_archiver.path)
+        deleted += removed
+        if removed < PRUNE_BATCH_SIZE:
+            return deleted
+        await asyncio.sleep(PRUNE_BATCH_PAUSE)
+# ---------- PILLORY FUNCTIONS ----------
 def set_pillory_channel(guild_id, channel_id):
-    """Set the pillory channel for a guild with upsert"""
+    """Set the pillory channel for a guild"""
     try:
-        with get_db_connection() as db:
-            existing = db.execute("SELECT * FROM pillory_config WHERE guild_id=?", (guild_id,)).fetchone()
-            if existing:
-                db.execute("UPDATE pillory_config SET pillory_channel=? WHERE guild_id=?", (channel_id, guild_id))
-            else:
-                db.execute("INSERT INTO pillory_config (guild_id, pillory_channel) VALUES (?,?)", (guild_id, channel_id))
-            db.commit()
+        update_guild_config(guild_id, "pillory_channel", channel_id)
     except sqlite3.Error as e:
         print(f"Error setting pillory channel: {e}")
         raise
-def get_pillory_role(guild_id):
-    """Get the pillory role for a guild"""
-    try:
-        with get_db_connection() as db:
-            row = db.execute("SELECT pillory_role FROM pillory_config WHERE guild_id=?", (guild_id,)).fetchone()
-            return row[0] if row and row[0] else None
-    except sqlite3.Error:
-        return None
 def set_pillory_role(guild_id, role_id):
     """Set the pillory role for a guild"""
     try:
-        with get_db_connection() as db:
-            existing = db.execute("SELECT * FROM pillory_config WHERE guild_id=?", (guild_id,)).fetchone()
-            if existing:
-                db.execute("UPDATE pillory_config SET pillory_role=? WHERE guild_id=?", (role_id, guild_id))
-            else:
-                db.execute("INSERT INTO pillory_config (guild_id, pillory_role) VALUES (?,?)", (guild_id, role_id))
-            db.commit()
+        update_guild_config(guild_id, "pillory_role", role_id)
     except sqlite3.Error as e:
         print(f"Error setting pillory role: {e}")
         raise
-def get_pillory_bypass_roles(guild_id):
-    """Get pillory bypass roles for a guild"""
-    try:
-        with get_db_connection() as db:
-            row = db.execute("SELECT bypass_roles FROM pillory_config WHERE guild_id=?", (guild_id,)).fetchone()
-            return row[0] if row and row[0] else None
-    except sqlite3.Error:
-        return None
 def set_pillory_bypass_roles(guild_id, role_ids):
     """Set pillory bypass roles for a guild"""
     try:
-        roles_str = ",".join(map(str, role_ids)) if role_ids else ""
-        with get_db_connection() as db:
-            existing = db.execute("SELECT * FROM pillory_config WHERE guild_id=?", (guild_id,)).fetchone()
-            if existing:
-                db.execute("UPDATE pillory_config SET bypass_roles=? WHERE guild_id=?", (roles_str, guild_id))
-            else:
-                db.execute("INSERT INTO pillory_config (guild_id, bypass_roles) VALUES (?,?)", (guild_id, roles_str))
-            db.commit()
+        replace_pillory_role_set(guild_id, "bypass", role_ids)
     except sqlite3.Error as e:
         print(f"Error setting bypass roles: {e}")
         raise
-def get_pillory_allowed_roles(guild_id):
-    """Get pillory allowed roles for a guild"""
-    try:
-        with get_db_connection() as db:
-            row = db.execute("SELECT allowed_roles FROM pillory_config WHERE guild_id=?", (guild_id,)).fetchone()
-            return row[0] if row and row[0] else None
-    except sqlite3.Error:
-        return None
 def set_pillory_allowed_roles(guild_id, role_ids):
     """Set pillory allowed roles for a guild"""
     try:
-        roles_str = ",".join(map(str, role_ids)) if role_ids else ""
-        with get_db_connection() as db:
-            existing = db.execute("SELECT * FROM pillory_config WHERE guild_id=?", (guild_id,)).fetchone()
-            if existing:
-                db.execute("UPDATE pillory_config SET allowed_roles=? WHERE guild_id=?", (roles_str, guild_id))
-            else:
-                db.execute("INSERT INTO pillory_config (guild_id, allowed_roles) VALUES (?,?)", (guild_id, roles_str))
-            db.commit()
+        replace_pillory_role_set(guild_id, "allowed", role_ids)
     except sqlite3.Error as e:
         print(f"Error setting allowed roles: {e}")
         raise
-def can_use_pillory(guild_id, user_id):
-    """Check if user can use pillory commands based on allowed roles"""
-    try:
-        allowed_roles_str = get_pillory_allowed_roles(guild_id)
-        if not allowed_roles_str:
-            return True # No restrictions set
-        allowed_role_ids = [int(r) for r in allowed_roles_str.split(',') if r]
-        if not allowed_role_ids:
-            return True
-        guild = bot.get_guild(guild_id)
-        if not guild:
-            return False
-        member = guild.get_member(user_id)
-        if not member:
-            return False
-        # Check if user has any of the allowed roles or mod permissions
-        return any(role.id in allowed_role_ids for role in member.roles) or member.guild_permissions.moderate_members
-    except Exception as e:
-        print(f"Error checking pillory permissions: {e}")
-        return True
-def has_pillory_bypass(guild_id, user_id):
-    """Check if user has pillory bypass role"""
-    try:
-        bypass_roles_str = get_pillory_bypass_roles(guild_id)
-        if not bypass_roles_str:
-            return False
-        bypass_role_ids = [int(r) for r in bypass_roles_str.split(',') if r]
-        if not bypass_role_ids:
-            return False
-        guild = bot.get_guild(guild_id)
-        if not guild:
-            return False
-        member = guild.get_member(user_id)
-        if not member:
-            return False
-        # Check if user has any bypass role
-        return any(role.id in bypass_role_ids for role in member.roles)
-    except Exception as e:
-        print(f"Error checking bypass: {e}")
-        return False
+def member_role_ids(member):
+    """The ids of a member's roles as a set, ready for intersection"""
+    return {role.id for role in member.roles}
+def can_use_pillory(config, member):
+    """Check if member can use pillory commands based on the cached allowed roles"""
+    if not config.allowed_roles:
+        return True # No restrictions set
+    # Holding any allowed role, or mod permissions, is enough
+    return not config.allowed_roles.isdisjoint(member_role_ids(member)) or member.guild_permissions.moderate_members
+def has_pillory_bypass(config, member):
+    """Check if member holds one of the cached bypass roles"""
+    return bool(config.bypass_roles) and not config.bypass_roles.isdisjoint(member_role_ids(member))
 def add_pillory(guild_id, user_id, duration_minutes, reason):
     """Add a new pillory with proper error handling"""
     try:
@@ -640,7 +1804,7 @@ def add_pillory(guild_id, user_id, duration_minutes, reason):
             db.execute("""
             INSERT INTO active_pillories (guild_id, user_id, start_time, end_time, reason)
             VALUES (?,?,?,?,?)
-            """, (guild_id, user_id, start_time.isoformat(), end_time.isoformat(), reason))
+            """, (guild_id, user_id, epoch_ms(start_time), epoch_ms(end_time), reason))
             pillory_id = db.execute("SELECT last_insert_rowid()").fetchone()[0]
             db.commit()
         return pillory_id
@@ -650,7 +1814,7 @@ def add_pillory(guild_id, user_id, duration_minutes, reason):
 def get_active_pillories(guild_id):
     """Get all active pillories for a guild"""
     try:
-        with get_db_connection() as db:
+        with get_db_reader() as db:
             rows = db.execute("""
             SELECT id, user_id, start_time, end_time, reason
             FROM active_pillories
@@ -664,14 +1828,16 @@ def end_pillory(pillory_id):
     """End a pillory by ID"""
     try:
         with get_db_connection() as db:
+            db.execute("BEGIN")
             db.execute("UPDATE active_pillories SET active=0 WHERE id=?", (pillory_id,))
-            db.commit()
+            cancel_jobs(db, "pillory_update", [pillory_id])
+            db.execute("COMMIT")
     except Exception as e:
         print(f"Error ending pillory: {e}")
 def is_user_pilloried(guild_id, user_id):
     """Check if user is currently pilloried"""
     try:
-        with get_db_connection() as db:
+        with get_db_reader() as db:
             row = db.execute("""
             SELECT id FROM active_pillories
             WHERE guild_id=? AND user_id=? AND active=1
@@ -680,6 +1846,43 @@ def is_user_pilloried(guild_id, user_id):
     except Exception as e:
         print(f"Error checking if user is pilloried: {e}")
         return None
+def get_running_pillory_members(now_ms):
+    """Get (guild_id, user_id) for every sentence still running at now_ms, across all guilds"""
+    with get_db_reader() as db:
+        return db.execute("SELECT guild_id, user_id FROM active_pillories WHERE active=1 AND end_time > ?",
+                          (now_ms,)).fetchall()
+def get_pillory(pillory_id, guild_id):
+    """Get a pillory's user and active flag within a guild"""
+    with get_db_reader() as db:
+        return db.execute("SELECT user_id, active FROM active_pillories WHERE id=? AND guild_id=?",
+                          (pillory_id, guild_id)).fetchone()
+def get_running_pillories(pillory_ids):
+    """Get guild, user, reason and sentence window for those of pillory_ids still active"""
+    placeholders = ",".join("?" * len(pillory_ids))
+    with get_db_reader() as db:
+        rows = db.execute(f"""
+        SELECT id, guild_id, user_id, reason, start_time, end_time
+        FROM active_pillories
+        WHERE active=1 AND id IN ({placeholders})
+        """, pillory_ids).fetchall()
+        return {row[0]: row for row in rows}
+def get_pillory_expiries():
+    """Get the id and end time of every active pillory, used to seed the expiry scheduler"""
+    with get_db_reader() as db:
+        return db.execute("SELECT id, end_time FROM active_pillories WHERE active=1").fetchall()
+def end_pillories(pillory_ids):
+    """End a batch of pillories in one transaction, returning (id, guild_id, user_id) for those still active"""
+    placeholders = ",".join("?" * len(pillory_ids))
+    with get_db_connection() as db:
+        db.execute("BEGIN IMMEDIATE")
+        rows = db.execute(f"""
+        SELECT id, guild_id, user_id FROM active_pillories
+        WHERE active=1 AND id IN ({placeholders})
+        """, pillory_ids).fetchall()
+        db.execute(f"UPDATE active_pillories SET active=0 WHERE active=1 AND id IN ({placeholders})", pillory_ids)
+        cancel_jobs(db, "pillory_update", pillory_ids)
+        db.execute("COMMIT")
+        return rows
 # ---------- MODERATION FUNCTIONS ----------
 def add_warning(guild_id, user_id, moderator_id, reason):
     """Add a warning with proper error handling"""
@@ -688,7 +1891,7 @@ def add_warning(guild_id, user_id, moderator_id, reason):
             db.execute("""
             INSERT INTO warnings (guild_id, user_id, moderator_id, reason, timestamp)
             VALUES (?,?,?,?,?)
-            """, (guild_id, user_id, moderator_id, reason, utcnow().isoformat()))
+            """, (guild_id, user_id, moderator_id, reason, epoch_ms()))
             db.commit()
     except Exception as e:
         print(f"Error adding warning: {e}")
@@ -696,7 +1899,7 @@ def add_warning(guild_id, user_id, moderator_id, reason):
 def get_warnings(guild_id, user_id):
     """Get warnings for a user"""
     try:
-        with get_db_connection() as db:
+        with get_db_reader() as db:
             rows = db.execute("""
             SELECT moderator_id, reason, timestamp
             FROM warnings
@@ -707,6 +1910,11 @@ def get_warnings(guild_id, user_id):
     except Exception as e:
         print(f"Error getting warnings: {e}")
         return []
+def clear_warnings(guild_id, user_id):
+    """Remove every warning for a user"""
+    with get_db_connection() as db:
+        db.execute("DELETE FROM warnings WHERE guild_id=? AND user_id=?", (guild_id, user_id))
+        db.commit()
 def add_moderation_log(guild_id, moderator_id, target_id, action, reason):
     """Add moderation log entry"""
     try:
@@ -714,16 +1922,105 @@ def add_moderation_log(guild_id, moderator_id, target_id, action, reason):
             db.execute("""
             INSERT INTO moderation_logs (guild_id, moderator_id, target_id, action, reason, timestamp)
             VALUES (?,?,?,?,?,?)
-            """, (guild_id, moderator_id, target_id, action, reason, utcnow().isoformat()))
+            """, (guild_id, moderator_id, target_id, action, reason, epoch_ms()))
             db.commit()
     except Exception as e:
         print(f"Error adding moderation log: {e}")
         raise
+def record_mass_moderation(guild_id, moderator_id, action, reason, target_ids, mute_end_time=None):
+    """Log a mass action against every target in one transaction; for mutes also record them and return their ids"""
+    now = epoch_ms()
+    mute_ids = {}
+    with get_db_connection() as db:
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany("""
+        INSERT INTO moderation_logs (guild_id, moderator_id, target_id, action, reason, timestamp)
+        VALUES (?,?,?,?,?,?)
+        """, [(guild_id, moderator_id, target_id, action, reason, now) for target_id in target_ids])
+        if mute_end_time is not None:
+            db.executemany("UPDATE mutes SET active=0 WHERE guild_id=? AND user_id=? AND active=1",
+                           [(guild_id, target_id) for target_id in target_ids])
+            for target_id in target_ids:
+                mute_ids[target_id] = db.execute("""
+                INSERT INTO mutes (guild_id, user_id, moderator_id, end_time, reason)
+                VALUES (?,?,?,?,?)
+                """, (guild_id, target_id, moderator_id, mute_end_time, reason)).lastrowid
+        db.execute("COMMIT")
+    return mute_ids
+# ---------- MUTE FUNCTIONS ----------
+def add_mute(guild_id, user_id, moderator_id, end_time, reason):
+    """Record a timeout ending at end_time (epoch ms), replacing any running mute for the member"""
+    with get_db_connection() as db:
+        db.execute("BEGIN")
+        db.execute("UPDATE mutes SET active=0 WHERE guild_id=? AND user_id=? AND active=1", (guild_id, user_id))
+        mute_id = db.execute("""
+        INSERT INTO mutes (guild_id, user_id, moderator_id, end_time, reason)
+        VALUES (?,?,?,?,?)
+        """, (guild_id, user_id, moderator_id, end_time, reason)).lastrowid
+        db.execute("COMMIT")
+        return mute_id
+def end_member_mutes(guild_id, user_id):
+    """Mark a member's running mute as lifted"""
+    with get_db_connection() as db:
+        db.execute("UPDATE mutes SET active=0 WHERE guild_id=? AND user_id=? AND active=1", (guild_id, user_id))
+def get_active_mutes(guild_id):
+    """Get running mutes for a guild, soonest to lift first"""
+    with get_db_reader() as db:
+        return db.execute("""
+        SELECT id, user_id, moderator_id, end_time, reason
+        FROM mutes
+        WHERE guild_id=? AND active=1
+        ORDER BY end_time
+        """, (guild_id,)).fetchall()
+def get_mute_expiries():
+    """Get the id and end time of every running mute, used to seed the expiry scheduler"""
+    with get_db_reader() as db:
+        return db.execute("SELECT id, end_time FROM mutes WHERE active=1").fetchall()
+def end_mutes(mute_ids):
+    """Lift a batch of mutes and log them in one transaction, returning (id, guild_id, user_id) for those still active"""
+    placeholders = ",".join("?" * len(mute_ids))
+    with get_db_connection() as db:
+        db.execute("BEGIN IMMEDIATE")
+        rows = db.execute(f"SELECT id, guild_id, user_id FROM mutes WHERE active=1 AND id IN ({placeholders})",
+                          mute_ids).fetchall()
+        db.execute(f"UPDATE mutes SET active=0 WHERE active=1 AND id IN ({placeholders})", mute_ids)
+        now = epoch_ms()
+        db.executemany("""
+        INSERT INTO moderation_logs (guild_id, moderator_id, target_id, action, reason, timestamp)
+        VALUES (?,NULL,?,'unmute','Mute expired',?)
+        """, [(guild_id, user_id, now) for _, guild_id, user_id in rows])
+        db.execute("COMMIT")
+        return rows
+def reconcile_mutes(guild_ids, live_timeouts):
+    """Make the mutes table match live timeouts ({(guild_id, user_id): end ms}) for the given guilds"""
+    with get_db_connection() as db:
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS live_guilds (guild_id INTEGER PRIMARY KEY)")
+        db.execute("DELETE FROM live_guilds")
+        db.executemany("INSERT INTO live_guilds (guild_id) VALUES (?)", [(guild_id,) for guild_id in guild_ids])
+        recorded = {
+            (guild_id, user_id): (mute_id, end_time)
+            for mute_id, guild_id, user_id, end_time in db.execute("""
+            SELECT id, guild_id, user_id, end_time FROM mutes
+            WHERE active=1 AND guild_id IN (SELECT guild_id FROM live_guilds)
+            """).fetchall()
+        }
+        lifted = [(mute_id,) for key, (mute_id, _) in recorded.items() if key not in live_timeouts]
+        moved = [(live_timeouts[key], mute_id) for key, (mute_id, end_time) in recorded.items()
+                 if key in live_timeouts and live_timeouts[key] != end_time]
+        found = [(guild_id, user_id, end_time, "Timeout found at startup")
+                 for (guild_id, user_id), end_time in live_timeouts.items() if (guild_id, user_id) not in recorded]
+        db.executemany("UPDATE mutes SET active=0 WHERE id=?", lifted)
+        db.executemany("UPDATE mutes SET end_time=? WHERE id=?", moved)
+        db.executemany("INSERT INTO mutes (guild_id, user_id, end_time, reason) VALUES (?,?,?,?)", found)
+        db.execute("DROP TABLE live_guilds")
+        db.execute("COMMIT")
+    return len(found), len(moved), len(lifted)
 # ---------- CHANNEL LOCK FUNCTIONS ----------
 def is_channel_locked(guild_id, channel_id):
     """Check if a channel is currently locked"""
     try:
-        with get_db_connection() as db:
+        with get_db_reader() as db:
             row = db.execute("""
             SELECT id FROM channel_locks
             WHERE guild_id=? AND channel_id=? AND active=1
@@ -739,13 +2036,23 @@ def lock_channel(guild_id, channel_id, moderator_id, reason):
             db.execute("""
             INSERT INTO channel_locks (guild_id, channel_id, moderator_id, reason, timestamp)
             VALUES (?,?,?,?,?)
-            """, (guild_id, channel_id, moderator_id, reason, utcnow().isoformat()))
+            """, (guild_id, channel_id, moderator_id, reason, epoch_ms()))
             lock_id = db.execute("SELECT last_insert_rowid()").fetchone()[0]
             db.commit()
         return lock_id
     except Exception as e:
         print(f"Error locking channel: {e}")
         return None
+def lock_channels(guild_id, channel_ids, moderator_id, reason):
+    """Record locks for many channels in one transaction"""
+    now = epoch_ms()
+    with get_db_connection() as db:
+        db.execute("BEGIN")
+        db.executemany("""
+        INSERT INTO channel_locks (guild_id, channel_id, moderator_id, reason, timestamp)
+        VALUES (?,?,?,?,?)
+        """, [(guild_id, channel_id, moderator_id, reason, now) for channel_id in channel_ids])
+        db.execute("COMMIT")
 def unlock_channel(lock_id, reason):
     """Unlock a channel"""
     try:
@@ -757,7 +2064,7 @@ def unlock_channel(lock_id, reason):
 def get_locked_channels(guild_id):
     """Get all locked channels in a guild"""
     try:
-        with get_db_connection() as db:
+        with get_db_reader() as db:
             rows = db.execute("""
             SELECT id, channel_id, moderator_id, reason, timestamp
             FROM channel_locks
@@ -768,35 +2075,167 @@ def get_locked_channels(guild_id):
     except Exception as e:
         print(f"Error getting locked channels: {e}")
         return []
-# ---------- BACKGROUND TASKS ----------
-@tasks.loop(minutes=1)
-async def check_pillories():
-    """Background task to check and end expired pillories"""
-    try:
-        now = utcnow()
-        with get_db_connection() as db:
-            rows = db.execute("""
-            SELECT id, guild_id, user_id, end_time
-            FROM active_pillories
-            WHERE active=1
-            """).fetchall()
-            for pillory_id, guild_id, user_id, end_time_str in rows:
+# ---------- SCHEDULED JOBS ----------
+JOB_POLL_SECONDS = int(os.getenv("JOB_POLL_SECONDS", "15"))
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", "100"))
+PILLORY_UPDATE_INTERVAL_MS = 5 * 60 * 1000
+job_handlers = {}
+def job_handler(kind):
+    """Register the coroutine that runs due jobs of one kind; it returns {job_id: next run_at or None}"""
+    def register(func):
+        job_handlers[kind] = func
+        return func
+    return register
+def add_scheduled_job(kind, guild_id, target_id, run_at):
+    """Persist a job to run at run_at (epoch ms)"""
+    with get_db_connection() as db:
+        db.execute("INSERT INTO scheduled_jobs (kind, guild_id, target_id, run_at) VALUES (?,?,?,?)",
+                   (kind, guild_id, target_id, run_at))
+def cancel_jobs(db, kind, target_ids):
+    """Drop pending jobs of a kind for the given targets, inside the caller's transaction"""
+    placeholders = ",".join("?" * len(target_ids))
+    db.execute(f"DELETE FROM scheduled_jobs WHERE kind=? AND target_id IN ({placeholders})", (kind, *target_ids))
+def get_due_jobs(now_ms, limit):
+    """Get the oldest jobs due by now_ms as (id, kind, guild_id, target_id, run_at)"""
+    with get_db_reader() as db:
+        return db.execute("""
+        SELECT id, kind, guild_id, target_id, run_at
+        FROM scheduled_jobs
+        WHERE run_at <= ?
+        ORDER BY run_at
+        LIMIT ?
+        """, (now_ms, limit)).fetchall()
+def finish_jobs(outcomes):
+    """Reschedule or delete a batch of run jobs in one transaction"""
+    with get_db_connection() as db:
+        db.execute("BEGIN")
+        db.executemany("UPDATE scheduled_jobs SET run_at=? WHERE id=?",
+                       [(run_at, job_id) for job_id, run_at in outcomes.items() if run_at is not None])
+        db.executemany("DELETE FROM scheduled_jobs WHERE id=?",
+                       [(job_id,) for job_id, run_at in outcomes.items() if run_at is None])
+        db.execute("COMMIT")
+async def run_due_jobs():
+    """Dispatch every due job, a batch at a time, grouped by kind"""
+    ran = 0
+    while True:
+        jobs = await run_db(get_due_jobs, epoch_ms(), JOB_BATCH_SIZE)
+        if not jobs:
+            return ran
+        by_kind = {}
+        for job in jobs:
+            by_kind.setdefault(job[1], []).append(job)
+        outcomes = {}
+        for kind, kind_jobs in by_kind.items():
+            handler = job_handlers.get(kind)
+            if handler is None:
+                print(f"No handler for scheduled job kind {kind}; dropping {len(kind_jobs)} jobs")
+                outcomes.update((job[0], None) for job in kind_jobs)
+                continue
+            try:
+                outcomes.update(await handler(kind_jobs))
+            except Exception as e:
+                # Leave these jobs in place, but behind this batch so one bad kind cannot wedge the queue
+                print(f"Error running {kind} jobs: {e}")
+                retry_at = epoch_ms() + JOB_POLL_SECONDS * 1000
+                outcomes.update((job[0], retry_at) for job in kind_jobs)
+        await run_db(finish_jobs, outcomes)
+        ran += len(jobs)
+        if len(jobs) < JOB_BATCH_SIZE:
+            return ran
+def get_all_channel_locks():
+    """Get every active channel lock across all guilds"""
+    with get_db_reader() as db:
+        return db.execute("SELECT id, guild_id, channel_id FROM channel_locks WHERE active=1").fetchall()
+def close_channel_locks(lock_ids, reason):
+    """Mark a batch of locks as lifted in one transaction"""
+    with get_db_connection() as db:
+        db.execute("BEGIN")
+        db.executemany("UPDATE channel_locks SET active=0, unlock_reason=? WHERE id=?",
+                       [(reason, lock_id) for lock_id in lock_ids])
+        db.execute("COMMIT")
+# ---------- EXPIRY SCHEDULER ----------
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "100"))
+EXPIRY_RETRY_SECONDS = int(os.getenv("EXPIRY_RETRY_SECONDS", "30"))
+class ExpiryScheduler:
+    """Min-heap of (due_ms, kind, id) timers that sleeps until the earliest one is due"""
+    def __init__(self, batch_size=100, retry_seconds=30):
+        self.batch_size = max(1, batch_size)
+        self.retry_ms = retry_seconds * 1000
+        self._heap = []
+        self._due = {} # (kind, id) -> due_ms; heap entries that disagree were cancelled or rescheduled
+        self._handlers = {}
+        self._wake = asyncio.Event()
+        self._task = None
+        self.fired = 0
+    def handler(self, kind):
+        """Register the coroutine that receives every due id of one kind as a list"""
+        def register(func):
+            self._handlers[kind] = func
+            return func
+        return register
+    def schedule(self, kind, item_id, due_ms):
+        """Fire item_id at due_ms, replacing any earlier timer for it"""
+        self._due[(kind, item_id)] = due_ms
+        heapq.heappush(self._heap, (due_ms, kind, item_id))
+        if self._heap[0][0] == due_ms:
+            self._wake.set() # New earliest deadline; re-arm the sleep
+    def cancel(self, kind, item_id):
+        """Drop a timer; its heap entry is discarded lazily when it reaches the top"""
+        self._due.pop((kind, item_id), None)
+    def __len__(self):
+        return len(self._due)
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+    def start(self):
+        if not self.is_running():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+    def _pop_due(self, now):
+        due = {}
+        taken = 0
+        while self._heap and self._heap[0][0] <= now and taken < self.batch_size:
+            due_ms, kind, item_id = heapq.heappop(self._heap)
+            if self._due.get((kind, item_id)) != due_ms:
+                continue # Cancelled or rescheduled
+            del self._due[(kind, item_id)]
+            due.setdefault(kind, []).append(item_id)
+            taken += 1
+        return due
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            due = self._pop_due(epoch_ms())
+            for kind, item_ids in due.items():
                 try:
-                    end_time = dt.fromisoformat(end_time_str).replace(tzinfo=timezone.utc)
-                    if now >= end_time:
-                        # End pillory
-                        db.execute("UPDATE active_pillories SET active=0 WHERE id=?", (pillory_id,))
-                        # Notify in pillory channel
-                        guild = bot.get_guild(guild_id)
-                        if guild:
-                            pillory_channel_id = get_pillory_channel(guild_id)
-                            if pillory_channel_id:
-                                channel = guild.get_channel(pillory_channel_id)
-                                if channel:
-                                    member = guild.get_member(user_id)
-                                    if member:
-                                        release_ceremonies = [
-                                            f"""👑 **ROYAL DECREE - RELEASE GRANTED** 👑
+                    await self._handlers[kind](item_ids)
+                    self.fired += len(item_ids)
+                except Exception as e:
+                    print(f"Error handling {kind} expiries: {e}")
+                    retry_at = epoch_ms() + self.retry_ms
+                    for item_id in item_ids:
+                        self.schedule(kind, item_id, retry_at)
+            if due:
+                continue # A full batch may have left more due entries behind
+            timeout = (self._heap[0][0] - epoch_ms()) / 1000 if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+expiry_scheduler = ExpiryScheduler(batch_size=EXPIRY_BATCH_SIZE, retry_seconds=EXPIRY_RETRY_SECONDS)
+async def announce_pillory_release(guild_id, user_id):
+    """Proclaim a served sentence in the guild's pillory channel"""
+    guild = bot.get_guild(guild_id)
+    if not guild:
+        return
+    pillory_channel_id = (await get_guild_config(guild_id)).pillory_channel
+    channel = guild.get_channel(pillory_channel_id) if pillory_channel_id else None
+    member = guild.get_member(user_id)
+    if not channel or not member:
+        return
+    release_ceremonies = [
+        f"""👑 **ROYAL DECREE - RELEASE GRANTED** 👑
 @here
 **BY THE MERCY AND WISDOM OF THE CROWN**
 {member.mention} hath been RELEASED from the pillory by royal mercy after serving their full sentence!
@@ -805,7 +2244,7 @@ async def check_pillories():
 *The Crown shows clemency, but remembers all transgressions!*
 *Go forth and sin no more, good subject!*
 **THE KING'S MERCY PREVAILS!** 🏰""",
-                                            f"""🕊️ **PROCLAMATION OF RELEASE** 🕊️
+        f"""🕊️ **PROCLAMATION OF RELEASE** 🕊️
 @here
 **Hear ye, hear ye!** {member.mention} is FREED from yonder pillory!
 **⚔️ The sentence is complete!**
@@ -813,17 +2252,538 @@ async def check_pillories():
 *Let this be a lesson learned!*
 *Walk henceforth with greater wisdom!*
 **BY ORDER OF THE REALM!** 📜"""
-                                        ]
-                                        await channel.send(random.choice(release_ceremonies))
-                except ValueError as e:
-                    print(f"Error parsing end_time: {e}")
-                    continue
-            db.commit()
+    ]
+    await announce(channel, random.choice(release_ceremonies))
+@expiry_scheduler.handler("pillory")
+async def expire_pillories(pillory_ids):
+    """End every due pillory in one transaction, then proclaim the releases"""
+    released = await run_db(end_pillories, pillory_ids)
+    role_fixes = []
+    for pillory_id, guild_id, user_id in released:
+        guild = bot.get_guild(guild_id)
+        pillory_role_id = (await get_guild_config(guild_id)).pillory_role
+        member = guild.get_member(user_id) if guild else None
+        pillory_role = guild.get_role(pillory_role_id) if guild and pillory_role_id else None
+        if member and pillory_role and pillory_role in member.roles:
+            role_fixes.append(partial(enforce, ("member_roles", guild_id), member.remove_roles, pillory_role,
+                                      reason="Pillory sentence served"))
+    await run_repairs(role_fixes)
+    for pillory_id, guild_id, user_id in released:
+        try:
+            await announce_pillory_release(guild_id, user_id)
+        except Exception as e:
+            print(f"Error announcing release of pillory #{pillory_id}: {e}")
+@job_handler("pillory_update")
+async def send_pillory_updates(jobs):
+    """Post the periodic shame bulletin for each running pillory and book the next one"""
+    pillories = await run_db(get_running_pillories, [job[3] for job in jobs])
+    now = epoch_ms()
+    outcomes = {}
+    for job_id, kind, guild_id, pillory_id, run_at in jobs:
+        pillory = pillories.get(pillory_id)
+        outcomes[job_id] = None
+        if not pillory:
+            continue # Pardoned or released since the job was booked
+        _, guild_id, user_id, reason, start_time, end_time = pillory
+        remaining = (end_time - now) // 60000
+        if remaining <= 0:
+            continue
+        if now + PILLORY_UPDATE_INTERVAL_MS < end_time:
+            outcomes[job_id] = now + PILLORY_UPDATE_INTERVAL_MS
+        guild = bot.get_guild(guild_id)
+        pillory_channel_id = (await get_guild_config(guild_id)).pillory_channel
+        channel = guild.get_channel(pillory_channel_id) if guild and pillory_channel_id else None
+        member = guild.get_member(user_id) if guild else None
+        if not channel or not member:
+            continue
+        try:
+            update_message = random.choice(PILLORY_UPDATE_MESSAGES).format(
+                user=member.display_name.upper(),
+                reason=reason,
+                elapsed=(now - start_time) // 60000,
+                remaining=remaining
+            )
+            await announce(channel, update_message)
+            # Add extra insult for more shame
+            insult = random.choice(PILLORY_INSULTS_EXTENDED)
+            await announce(channel, f"*{insult}*")
+        except Exception as e:
+            print(f"Error in pillory updates: {e}")
+    return outcomes
+@expiry_scheduler.handler("mute")
+async def expire_mutes(mute_ids):
+    """Close out mutes whose timeout has run, then chronicle each one"""
+    lifted = await run_db(end_mutes, mute_ids)
+    for mute_id, guild_id, user_id in lifted:
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            continue
+        member = guild.get_member(user_id)
+        await send_log_embed(
+            guild,
+            "unmute",
+            "🔊 Silence Lifted",
+            f"{member.mention if member else f'<@{user_id}>'} hath served their silence and may speak once more.",
+            fields=[("Mute", f"#{mute_id}", True)],
+            color="green"
+        )
+async def reconcile_and_schedule_mutes():
+    """Sync the mutes table with live member timeouts, then arm a timer for each running mute"""
+    now = epoch_ms()
+    live_timeouts = {}
+    for guild in bot.guilds:
+        for member in guild.members:
+            if member.timed_out_until and epoch_ms(member.timed_out_until) > now:
+                live_timeouts[(guild.id, member.id)] = epoch_ms(member.timed_out_until)
+    found, moved, lifted = await run_db(reconcile_mutes, [guild.id for guild in bot.guilds], live_timeouts)
+    rows = await run_db(get_mute_expiries)
+    for mute_id, end_time in rows:
+        expiry_scheduler.schedule("mute", mute_id, end_time or 0)
+    return len(rows), found, moved, lifted
+async def schedule_active_pillories():
+    """Seed the expiry scheduler with every running sentence; overdue ones fire at once"""
+    rows = await run_db(get_pillory_expiries)
+    for pillory_id, end_time in rows:
+        expiry_scheduler.schedule("pillory", pillory_id, end_time or 0)
+    return len(rows)
+# ---------- REALM RECONCILIATION ----------
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "4"))
+RECONCILE_MAX_RETRIES = int(os.getenv("RECONCILE_MAX_RETRIES", "3"))
+async def call_with_backoff(call):
+    """Run one Discord API call, backing off on server errors (discord.py sleeps out 429s itself)"""
+    for attempt in range(RECONCILE_MAX_RETRIES + 1):
+        try:
+            return await call()
+        except discord.HTTPException as e:
+            if e.status < 500 or attempt == RECONCILE_MAX_RETRIES:
+                raise
+            await asyncio.sleep(2 ** attempt)
+async def run_repairs(calls, concurrency=RECONCILE_CONCURRENCY):
+    """Run API calls with at most `concurrency` in flight; returns (succeeded, failed)"""
+    if not calls:
+        return 0, 0
+    limit = asyncio.Semaphore(max(1, concurrency))
+    async def repair(call):
+        async with limit:
+            try:
+                await call_with_backoff(call)
+                return True
+            except Exception as e:
+                print(f"Error repairing realm state: {e}")
+                return False
+    results = await asyncio.gather(*(repair(call) for call in calls))
+    succeeded = sum(results)
+    return succeeded, len(results) - succeeded
+async def reconcile_realm():
+    """Bring pillory roles and sealed channels back in line with the database after downtime"""
+    try:
+        started = time.perf_counter()
+        pilloried = await run_db(get_running_pillory_members, epoch_ms())
+        locks = await run_db(get_all_channel_locks)
+        running = {}
+        for guild_id, user_id in pilloried:
+            running.setdefault(guild_id, set()).add(user_id)
+        role_fixes = []
+        restored = stripped = 0
+        for guild in bot.guilds:
+            pillory_role_id = (await get_guild_config(guild.id)).pillory_role
+            pillory_role = guild.get_role(pillory_role_id) if pillory_role_id else None
+            if not pillory_role:
+                continue
+            sentenced = running.get(guild.id, set())
+            holders = {member.id for member in pillory_role.members}
+            for user_id in sentenced - holders:
+                member = guild.get_member(user_id)
+                if member:
+                    role_fixes.append(partial(enforce, ("member_roles", guild.id), member.add_roles, pillory_role,
+                                          reason="Pillory sentence still running"))
+                    restored += 1
+            for user_id in holders - sentenced:
+                member = guild.get_member(user_id)
+                role_fixes.append(partial(enforce, ("member_roles", guild.id), member.remove_roles, pillory_role,
+                                      reason="No pillory sentence on record"))
+                stripped += 1
+        # Seals lifted by hand (or whose channel is gone) while we were away are closed, not re-imposed
+        stale_locks = []
+        for lock_id, guild_id, channel_id in locks:
+            guild = bot.get_guild(guild_id)
+            if not guild:
+                continue
+            channel = guild.get_channel(channel_id)
+            if not channel or channel.overwrites_for(guild.default_role).send_messages is not False:
+                stale_locks.append(lock_id)
+        if stale_locks:
+            await run_db(close_channel_locks, stale_locks, "Unsealed outside the royal court")
+        succeeded, failed = await run_repairs(role_fixes)
+        elapsed = time.perf_counter() - started
+        print(f"✅ Reconciled realm state in {elapsed:.2f}s: {restored} pillory roles restored, "
+              f"{stripped} removed, {len(stale_locks)} stale seals closed, {failed} repairs failed")
+        return restored, stripped, len(stale_locks), failed
+    except Exception as e:
+        print(f"Error in reconcile_realm: {e}")
+reconcile_task = None
+# ---------- RAID DETECTION ----------
+RAID_ACTIONS = ("alert", "seal", "timeout")
+RAID_COOLDOWN_SECONDS = int(os.getenv("RAID_COOLDOWN_SECONDS", "300")) # Raid mode lasts this long after the last trip
+RAID_TIMEOUT_MINUTES = int(os.getenv("RAID_TIMEOUT_MINUTES", "60"))
+ACCOUNT_AGE_BUCKETS = ((1, "under a day"), (7, "under a week"), (30, "under a month"), (None, "older"))
+def account_age_bucket(member):
+    age_days = (utcnow() - member.created_at).total_seconds() / 86400
+    for index, (limit, _) in enumerate(ACCOUNT_AGE_BUCKETS):
+        if limit is None or age_days < limit:
+            return index
+class JoinRateDetector:
+    """Per-guild ring buffer of the last `threshold` joins; a raid is the ring filling within the window"""
+    def __init__(self):
+        self._rings = {} # guild_id -> deque of (monotonic time, member_id, age bucket), maxlen=threshold
+        self._buckets = {} # guild_id -> join counts per account-age bucket across the ring
+        self._raid_until = {} # guild_id -> monotonic time raid mode ends
+        self.trips = 0
+    def observe(self, guild_id, member_id, age_bucket, threshold, window):
+        """Record a join in O(1); returns True when this join trips (or extends) a raid"""
+        now = time.monotonic()
+        ring = self._rings.get(guild_id)
+        if ring is None or ring.maxlen != threshold:
+            ring = self._rings[guild_id] = deque(maxlen=threshold)
+            self._buckets[guild_id] = [0] * len(ACCOUNT_AGE_BUCKETS)
+        buckets = self._buckets[guild_id]
+        if len(ring) == threshold:
+            buckets[ring[0][2]] -= 1 # Evicted by the append below
+        ring.append((now, member_id, age_bucket))
+        buckets[age_bucket] += 1
+        if len(ring) == threshold and now - ring[0][0] <= window:
+            started = not self.in_raid(guild_id)
+            self._raid_until[guild_id] = now + RAID_COOLDOWN_SECONDS
+            if started:
+                self.trips += 1
+            return started
+        return False
+    def in_raid(self, guild_id):
+        return time.monotonic() < self._raid_until.get(guild_id, 0)
+    def recent_joiners(self, guild_id, window):
+        """Members in the ring who joined within the last `window` seconds"""
+        since = time.monotonic() - window
+        return [member_id for joined, member_id, _ in self._rings.get(guild_id, ()) if joined >= since]
+    def age_breakdown(self, guild_id):
+        counts = self._buckets.get(guild_id, [0] * len(ACCOUNT_AGE_BUCKETS))
+        return ", ".join(f"{count} {label}" for count, (_, label) in zip(counts, ACCOUNT_AGE_BUCKETS) if count)
+join_detector = JoinRateDetector()
+async def check_join_rate(member):
+    """Feed a join to the raid detector and respond if it trips; uses only cached settings"""
+    config = await get_guild_config(member.guild.id)
+    if not config.raid_threshold:
+        return
+    guild = member.guild
+    window = config.raid_window or 10
+    started = join_detector.observe(guild.id, member.id, account_age_bucket(member), config.raid_threshold, window)
+    targets = []
+    if config.raid_action == "timeout" and join_detector.in_raid(guild.id):
+        # On the trip, strike the whole ring; after that, every newcomer until raid mode lapses
+        targets = join_detector.recent_joiners(guild.id, window) if started else [member.id]
+    if targets or started:
+        # Respond in the background so this join's own log isn't held up by the whole raid response
+        task = asyncio.get_running_loop().create_task(respond_to_raid(guild, config, window, targets, started))
+        raid_responses.add(task)
+        task.add_done_callback(raid_responses.discard)
+raid_responses = set() # Running raid responses, kept referenced until they finish
+async def respond_to_raid(guild, config, window, targets, started):
+    """Time out the joiners, seal the realm and raise the alert, as the guild's raid action asks"""
+    try:
+        if targets:
+            await queue_raid_timeouts(guild, targets)
+        if not started:
+            return
+        sealed = await seal_guild(guild) if config.raid_action == "seal" else 0
+        await raise_raid_alert(guild, config, window, sealed)
+    except Exception as e:
+        print(f"Error in raid guard: {e}")
+raid_strike_queue = {} # guild_id -> joiners awaiting the next batched timeout
+async def queue_raid_timeouts(guild, member_ids):
+    """Gather raiders for a second so a flood costs one transaction per batch, not per join"""
+    queued = raid_strike_queue.get(guild.id)
+    if queued is not None:
+        queued.extend(member_ids)
+        return
+    raid_strike_queue[guild.id] = list(member_ids)
+    await asyncio.sleep(1)
+    await timeout_raiders(guild, dict.fromkeys(raid_strike_queue.pop(guild.id)))
+async def timeout_raiders(guild, member_ids):
+    """Time out suspected raiders and record the mutes in one transaction"""
+    duration = timedelta(minutes=RAID_TIMEOUT_MINUTES)
+    members = [m for m in map(guild.get_member, member_ids) if m and m.top_role < guild.me.top_role]
+    results = await gather_bounded([
+        enforce_in_bulk(member.timeout, duration, reason="Raid guard: join flood")
+        for member in members
+    ], limit=MASS_ACTION_CONCURRENCY)
+    struck = [member.id for member, result in zip(members, results) if not isinstance(result, Exception)]
+    if struck:
+        end_time = epoch_ms() + RAID_TIMEOUT_MINUTES * 60000
+        mute_ids = await run_db(record_mass_moderation, guild.id, bot.user.id, "mute", "Raid guard: join flood",
+                                struck, end_time)
+        for mute_id in mute_ids.values():
+            expiry_scheduler.schedule("mute", mute_id, end_time)
+    return len(struck)
+async def seal_guild(guild):
+    """Seal every text channel @everyone can currently speak in"""
+    everyone_role = guild.default_role
+    channels = [
+        channel for channel in guild.text_channels
+        if channel.permissions_for(everyone_role).send_messages
+        and channel.overwrites_for(everyone_role).send_messages is not False
+    ]
+    results = await gather_bounded([
+        enforce(("channel_permissions", channel.id), channel.set_permissions, everyone_role,
+                send_messages=False, reason="Raid guard: join flood")
+        for channel in channels
+    ], limit=MASS_ACTION_CONCURRENCY)
+    sealed = [channel.id for channel, result in zip(channels, results) if not isinstance(result, Exception)]
+    if sealed:
+        await run_db(lock_channels, guild.id, sealed, bot.user.id, "Raid guard: join flood")
+    return len(sealed)
+async def raise_raid_alert(guild, config, window, sealed):
+    """Rouse the moderators in the chronicle channel"""
+    log_channel = guild.get_channel(config.log_channel) if config.log_channel else None
+    if not log_channel:
+        return
+    response = {
+        "seal": f"🔒 {sealed} chambers sealed",
+        "timeout": f"🔇 Newcomers silenced for {RAID_TIMEOUT_MINUTES} minutes",
+    }.get(config.raid_action, "📯 No action taken; the watch awaits your command")
+    embed = medieval_embed(
+        title="🚨 THE GATES ARE STORMED 🚨",
+        description=f"**{config.raid_threshold}** travelers arrived within **{window}** seconds!",
+        color_name="red"
+    )
+    embed.add_field(name="🗓️ Account Ages", value=join_detector.age_breakdown(guild.id) or "Unknown", inline=False)
+    embed.add_field(name="⚔️ Response", value=response, inline=False)
+    embed.add_field(name="⏳ Raid Mode", value=f"Until {RAID_COOLDOWN_SECONDS // 60} minutes after the flood ebbs",
+                    inline=False)
+    await announce(log_channel, content="@here", embed=embed)
+# ---------- SPAM GUARD ----------
+SPAM_ACTIONS = ("delete", "timeout", "pillory")
+SPAM_RATE = float(os.getenv("SPAM_RATE", "1.0")) # Messages per second a member may sustain...
+SPAM_BURST = float(os.getenv("SPAM_BURST", "6")) # ...after a burst of this many
+SPAM_DUPLICATE_LIMIT = int(os.getenv("SPAM_DUPLICATE_LIMIT", "4")) # Identical messages in a row that count as spam
+SPAM_DUPLICATE_WINDOW = float(os.getenv("SPAM_DUPLICATE_WINDOW", "30"))
+SPAM_TIMEOUT_MINUTES = int(os.getenv("SPAM_TIMEOUT_MINUTES", "10"))
+SPAM_TRACKED_MEMBERS = int(os.getenv("SPAM_TRACKED_MEMBERS", "50000"))
+SPAM_IDLE_SECONDS = float(os.getenv("SPAM_IDLE_SECONDS", "300"))
+class SpamState:
+    """Token bucket and last-content fingerprint for one member"""
+    __slots__ = ("tokens", "seen", "content_hash", "repeats", "punished_until")
+    def __init__(self, now):
+        self.tokens = SPAM_BURST
+        self.seen = now
+        self.content_hash = None
+        self.repeats = 0
+        self.punished_until = 0.0
+class SpamTracker:
+    """LRU of per-member spam state; idle and least recent members fall off the front"""
+    def __init__(self, max_members=50000, idle_seconds=300):
+        self.max_members = max(1, max_members)
+        self.idle_seconds = idle_seconds
+        self._states = OrderedDict() # (guild_id, user_id) -> SpamState, least recently seen first
+        self.caught = 0
+    def __len__(self):
+        return len(self._states)
+    def check(self, guild_id, user_id, content):
+        """Charge one message; returns 'flood', 'duplicate' or None, plus whether the member is already punished"""
+        now = time.monotonic()
+        key = (guild_id, user_id)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = SpamState(now)
+        else:
+            self._states.move_to_end(key)
+            state.tokens = min(SPAM_BURST, state.tokens + (now - state.seen) * SPAM_RATE)
+        verdict = None
+        state.tokens -= 1
+        if state.tokens < 0:
+            verdict = "flood"
+        # Fingerprint the normalised text; repeats only count while they keep coming
+        content_hash = hash(" ".join(content.casefold().split())) if content else None
+        if content_hash is not None and content_hash == state.content_hash and now - state.seen <= SPAM_DUPLICATE_WINDOW:
+            state.repeats += 1
+            if state.repeats >= SPAM_DUPLICATE_LIMIT:
+                verdict = verdict or "duplicate"
+        else:
+            state.content_hash = content_hash
+            state.repeats = 1
+        state.seen = now
+        # Only now that this member is freshly seen, so a returning idler isn't evicted mid-check
+        self._evict(now)
+        already_punished = now < state.punished_until
+        if verdict and not already_punished:
+            state.punished_until = now + SPAM_TIMEOUT_MINUTES * 60
+            self.caught += 1
+        return verdict, already_punished
+    def _evict(self, now):
+        while self._states:
+            key, oldest = next(iter(self._states.items()))
+            if len(self._states) <= self.max_members and now - oldest.seen < self.idle_seconds:
+                break
+            del self._states[key]
+spam_tracker = SpamTracker(max_members=SPAM_TRACKED_MEMBERS, idle_seconds=SPAM_IDLE_SECONDS)
+async def check_spam(message):
+    """Run a message through the spam guard; returns True when it was treated as spam"""
+    config = await get_guild_config(message.guild.id)
+    if not config.spam_action or message.author.guild_permissions.manage_messages:
+        return False
+    verdict, already_punished = spam_tracker.check(message.guild.id, message.author.id, message.content)
+    if not verdict:
+        return False
+    try:
+        await enforce(("message_delete", message.channel.id), message.delete)
+    except discord.HTTPException:
+        pass
+    if already_punished or config.spam_action == "delete":
+        return True
+    member = message.author
+    reason = "Spam guard: message flood" if verdict == "flood" else "Spam guard: repeated messages"
+    try:
+        if config.spam_action == "timeout":
+            end_time = epoch_ms() + SPAM_TIMEOUT_MINUTES * 60000
+            await enforce(("member", message.guild.id), member.timeout, timedelta(minutes=SPAM_TIMEOUT_MINUTES),
+                          reason=reason)
+            mute_id = await run_db(add_mute, message.guild.id, member.id, bot.user.id, end_time, reason)
+            expiry_scheduler.schedule("mute", mute_id, end_time)
+            await run_db(add_moderation_log, message.guild.id, bot.user.id, member.id, "mute", reason)
+        elif config.spam_action == "pillory" and not has_pillory_bypass(config, member):
+            if not await run_db(is_user_pilloried, message.guild.id, member.id):
+                await place_in_pillory(message.guild, member, message.guild.me, SPAM_TIMEOUT_MINUTES, reason, config)
+    except (discord.HTTPException, ValueError) as e:
+        print(f"Error punishing spam in guild {message.guild.id}: {e}")
+    await send_log_embed(
+        message.guild,
+        "spam",
+        "🛡️ Spam Guard",
+        f"{member.mention} was caught spamming in {message.channel.mention} and met the royal **{config.spam_action}**.",
+        fields=[("📜 Offence", reason.split(": ", 1)[1].capitalize(), True), ("👤 Member", f"`{member.id}`", True)],
+        color="orange"
+    )
+    return True
+# ---------- WORD FILTER ----------
+WORD_FILTER_LIMIT = int(os.getenv("WORD_FILTER_LIMIT", "500")) # Patterns per guild
+WORD_FILTER_MAX_LENGTH = 100
+WORD_TOKEN = re.compile(r"\w+")
+def normalize_filter_pattern(pattern):
+    return " ".join(pattern.casefold().split())
+def trie_pattern(patterns):
+    """Prefix-factored alternation, so the regex engine walks shared prefixes once instead of every pattern"""
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[""] = {} # End of a pattern
+    def emit(node):
+        ends = "" in node
+        branches = [(r"\s+" if char == " " else re.escape(char)) + emit(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        alternation = "|".join(branches)
+        if ends:
+            return f"(?:{alternation})?"
+        return alternation if len(branches) == 1 else f"(?:{alternation})"
+    return emit(trie)
+class WordFilter:
+    """Banned words looked up per token, phrases by their first token, and a trie regex for the odd rest"""
+    __slots__ = ("words", "phrases", "leftovers")
+    def __init__(self, banned_words):
+        self.words = set()
+        self.phrases = {} # first token -> token tuples starting with it, longest first
+        leftovers = []
+        for pattern in banned_words:
+            tokens = tuple(WORD_TOKEN.findall(pattern))
+            if " ".join(tokens) != pattern:
+                leftovers.append(pattern) # Punctuation inside; tokens can't express it
+            elif len(tokens) == 1:
+                self.words.add(tokens[0])
+            else:
+                self.phrases.setdefault(tokens[0], []).append(tokens)
+        for candidates in self.phrases.values():
+            candidates.sort(key=len, reverse=True)
+        self.leftovers = re.compile(rf"(?<!\w){trie_pattern(leftovers)}(?!\w)") if leftovers else None
+    def search(self, content):
+        """The first banned pattern in content, or None; one pass over the tokens whatever the pattern count"""
+        folded = content.casefold() # Patterns are stored casefolded, so "Straße" meets "strasse"
+        if self.words or self.phrases:
+            tokens = WORD_TOKEN.findall(folded)
+            for position, token in enumerate(tokens):
+                if token in self.words:
+                    return token
+                for phrase in self.phrases.get(token, ()):
+                    if tuple(tokens[position:position + len(phrase)]) == phrase:
+                        return " ".join(phrase)
+        if self.leftovers:
+            match = self.leftovers.search(folded)
+            if match:
+                return match.group(0)
+        return None
+@lru_cache(maxsize=1024)
+def compile_word_filter(banned_words):
+    """Matcher for a guild's pattern set; cached per set, so it is rebuilt only when the list changes"""
+    return WordFilter(banned_words) if banned_words else None
+filtered_message_ids = set() # Messages the word filter is deleting, until their delete event arrives
+async def check_word_filter(message):
+    """Delete a message carrying a banned word or phrase; returns True when it was struck"""
+    config = await get_guild_config(message.guild.id)
+    word_filter = compile_word_filter(config.banned_words)
+    if word_filter is None or not message.content or message.author.guild_permissions.manage_messages:
+        return False
+    matched = word_filter.search(message.content)
+    if not matched:
+        return False
+    # The strike below logs the content itself; note the id so on_message_delete doesn't log it again
+    filtered_message_ids.add(message.id)
+    try:
+        await enforce(("message_delete", message.channel.id), message.delete)
+    except discord.HTTPException:
+        filtered_message_ids.discard(message.id)
+    await send_log_embed(
+        message.guild,
+        "word_filter",
+        "🚫 Forbidden Words Struck",
+        f"A scroll from {message.author.mention} in {message.channel.mention} bore forbidden words and was burned.",
+        fields=[
+            ("🔎 Matched", f"||{matched[:100]}||", True),
+            ("👤 Member", f"`{message.author.id}`", True),
+            ("📜 Content", message.content[:1024], False)
+        ],
+        color="red"
+    )
+    return True
+# ---------- BACKGROUND TASKS ----------
+@tasks.loop(seconds=JOB_POLL_SECONDS)
+async def run_scheduled_jobs():
+    """Background task dispatching due rows from scheduled_jobs"""
+    try:
+        await run_due_jobs()
+    except Exception as e:
+        print(f"Error in run_scheduled_jobs: {e}")
+@run_scheduled_jobs.before_loop
+async def before_jobs():
+    await bot.wait_until_ready()
+@tasks.loop(minutes=PRUNE_INTERVAL_MINUTES)
+async def prune_message_history():
+    """Background task enforcing message_history retention"""
+    try:
+        removed = await prune_message_history_once()
+        if removed:
+            print(f"🧹 Pruned {removed} old messages from the chronicles")
+        archived = await prune_attachment_archive_once()
+        if archived:
+            print(f"🧹 Removed {archived} archived attachments past retention")
     except Exception as e:
-        print(f"Error in check_pillories: {e}")
-@check_pillories.before_loop
-async def before_pillories():
+        print(f"Error in prune_message_history: {e}")
+@prune_message_history.before_loop
+async def before_prune():
     await bot.wait_until_ready()
+@tasks.loop(seconds=MESSAGE_FLUSH_MS / 1000)
+async def flush_message_buffer():
+    """Background task that group-commits buffered messages every MESSAGE_FLUSH_MS"""
+    await message_buffer.flush()
 # ---------- ENHANCED LOGGING EVENT HANDLERS ----------
 @bot.event
 async def on_message_edit(before, after):
@@ -832,10 +2792,10 @@ async def on_message_edit(before, after):
         return
     if not before.guild:
         return
+    # Get old message from history before the edited version is recorded
+    old_data = await lookup_message_history(before.id)
     # Store the edited message
     store_message(after)
-    # Get old message from history
-    old_data = get_message_history(before.id)
     old_content = old_data[0] if old_data else before.content
     # Create log embed
     fields = [
@@ -869,8 +2829,13 @@ async def on_message_delete(message):
         return
     if not message.guild:
         return
+    if message.id in filtered_message_ids:
+        filtered_message_ids.discard(message.id)
+        message_cache.discard(message.id)
+        return
     # Get stored message data
-    old_data = get_message_history(message.id)
+    old_data = await lookup_message_history(message.id)
+    message_cache.discard(message.id) # The message is gone; free its slot for live ones
     content = old_data[0] if old_data else message.content
     attachments_str = old_data[1] if old_data else None
     # Create log embed
@@ -887,6 +2852,14 @@ async def on_message_delete(message):
     elif message.attachments:
         attachment_info = "\n".join([f"📎 `{att.filename}` ({att.size/1024:.1f}KB)" for att in message.attachments])
         fields.append(("📎 Attachments", attachment_info, False))
+    # The CDN links die with the message; re-upload whatever the archive kept
+    files = []
+    try:
+        files = await attachment_archiver.evidence(message.id, message.guild.filesize_limit)
+    except Exception as e:
+        print(f"Error reading attachment archive: {e}")
+    if files:
+        fields.append(("🗄️ Archived", f"{len(files)} file(s) preserved and attached below", False))
     await send_log_embed(
         message.guild,
         "message_delete",
@@ -897,13 +2870,18 @@ async def on_message_delete(message):
         ),
         fields=fields,
         color="red",
-        thumbnail=str(message.author.avatar.url) if message.author.avatar else None
+        thumbnail=str(message.author.avatar.url) if message.author.avatar else None,
+        files=files
     )
 @bot.event
 async def on_member_join(member):
     """Log member joins with full detail"""
     if member.bot:
         return
+    try:
+        await check_join_rate(member)
+    except Exception as e:
+        print(f"Error in raid guard: {e}")
     created_date = f"<t:{int(member.created_at.timestamp())}:R>"
     fields = [
         ("👤 Member", f"{member.mention} (`{member.id}`)", True),
@@ -948,34 +2926,37 @@ async def on_member_remove(member):
 @bot.event
 async def on_user_update(before, after):
     """Log user profile changes (avatar, banner, etc.)"""
-    # Avatar changes
-    if before.avatar != after.avatar:
-        for guild in bot.guilds:
-            member = guild.get_member(before.id)
-            if member and not member.bot:
-                await send_log_embed(
-                    guild,
-                    "avatar_change",
-                    "🎭 Visage Altered",
-                    random.choice(LOG_MESSAGES["avatar_change"]).format(user=member.mention),
-                    fields=[("👤 User", f"{member.mention} (`{member.id}`)", True)],
-                    color="purple",
-                    thumbnail=str(after.avatar.url) if after.avatar else None
-                )
-    # Banner changes (if available)
-    if hasattr(before, 'banner') and hasattr(after, 'banner') and before.banner != after.banner:
-        for guild in bot.guilds:
-            member = guild.get_member(before.id)
-            if member and not member.bot:
-                await send_log_embed(
-                    guild,
-                    "banner_change",
-                    "🏰 Standard Updated",
-                    random.choice(LOG_MESSAGES["banner_change"]).format(user=member.mention),
-                    fields=[("👤 User", f"{member.mention} (`{member.id}`)", True)],
-                    color="blue",
-                    thumbnail=str(after.avatar.url) if after.avatar else None
-                )
+    avatar_changed = before.avatar != after.avatar
+    banner_changed = hasattr(before, 'banner') and hasattr(after, 'banner') and before.banner != after.banner
+    if not (avatar_changed or banner_changed) or after.bot:
+        return
+    thumbnail = str(after.avatar.url) if after.avatar else None
+    sends = []
+    for guild, member in logged_guild_members(after.id):
+        fields = [("👤 User", f"{member.mention} (`{member.id}`)", True)]
+        # Avatar changes
+        if avatar_changed:
+            sends.append(send_log_embed(
+                guild,
+                "avatar_change",
+                "🎭 Visage Altered",
+                random.choice(LOG_MESSAGES["avatar_change"]).format(user=member.mention),
+                fields=fields,
+                color="purple",
+                thumbnail=thumbnail
+            ))
+        # Banner changes (if available)
+        if banner_changed:
+            sends.append(send_log_embed(
+                guild,
+                "banner_change",
+                "🏰 Standard Updated",
+                random.choice(LOG_MESSAGES["banner_change"]).format(user=member.mention),
+                fields=fields,
+                color="blue",
+                thumbnail=thumbnail
+            ))
+    await gather_bounded(sends)
 @bot.event
 async def on_member_update(before, after):
     """Log member updates (nickname, roles, etc.)"""
@@ -1000,47 +2981,14 @@ async def on_member_update(before, after):
             color="yellow",
             thumbnail=str(after.avatar.url) if after.avatar else None
         )
-    # Role changes
-    added_roles = [role for role in after.roles if role not in before.roles and not role.is_default()]
-    removed_roles = [role for role in before.roles if role not in after.roles and not role.is_default()]
-    # Role additions
-    for role in added_roles:
-        fields = [
-            ("👤 Member", f"{after.mention} (`{after.id}`)", True),
-            ("⚔️ Role", f"{role.mention} (`{role.id}`)", True),
-            ("📊 Color", f"#{role.color.value:06x}" if role.color.value else "None", True)
-        ]
-        await send_log_embed(
-            after.guild,
-            "role_add",
-            "⚔️ Honor Bestowed",
-            random.choice(LOG_MESSAGES["role_add"]).format(
-                user=after.mention,
-                role=role.mention
-            ),
-            fields=fields,
-            color="green",
-            thumbnail=str(after.avatar.url) if after.avatar else None
-        )
-    # Role removals
-    for role in removed_roles:
-        fields = [
-            ("👤 Member", f"{after.mention} (`{after.id}`)", True),
-            ("🗡️ Role", f"{role.mention} (`{role.id}`)", True),
-            ("📊 Color", f"#{role.color.value:06x}" if role.color.value else "None", True)
-        ]
-        await send_log_embed(
-            after.guild,
-            "role_remove",
-            "🗡️ Honor Stripped",
-            random.choice(LOG_MESSAGES["role_remove"]).format(
-                user=after.mention,
-                role=role.mention
-            ),
-            fields=fields,
-            color="red",
-            thumbnail=str(after.avatar.url) if after.avatar else None
-        )
+    # Role changes: one set difference each way instead of scanning role lists
+    before_ids = {role.id for role in before.roles}
+    after_ids = {role.id for role in after.roles}
+    default_id = after.guild.default_role.id
+    added_ids = after_ids - before_ids - {default_id}
+    removed_ids = before_ids - after_ids - {default_id}
+    if added_ids or removed_ids:
+        await queue_role_change_log(after, added_ids, removed_ids)
 @bot.event
 async def on_guild_channel_create(channel):
     """Log channel creation"""
@@ -1122,7 +3070,12 @@ async def _help(ctx):
             "🏰 **Royal Administration**": [
                 ("help", "Display this royal charter of commands"),
                 ("setlogchannel <channel>", "Set the royal chronicle channel for all logs"),
+                ("setlogwebhook [on|off]", "Deliver the chronicles through a webhook"),
+                ("raidguard <joins> <seconds> <alert|seal|timeout>", "Watch the gates for join floods ('off' to stand down)"),
+                ("spamguard <delete|timeout|pillory|off>", "Answer floods and copy-paste spam"),
+                ("filter <add|remove|list> [words, ...]", "Manage the realm's forbidden words"),
                 ("psetchannel <channel>", "Set the pillory channel for public shaming"),
+                ("stats", "View the royal ledger of caches and queues"),
             ],
             "⚔️ **Pillory System**": [
                 ("pillory <member> <duration> <reason>", "Place a knave in public shame"),
@@ -1149,7 +3102,11 @@ async def _help(ctx):
                 ("unban <user_id> [reason]", "Grant royal pardon to an exile"),
                 ("mute <member> <duration> [reason]", "Silence a chatterer for a time"),
                 ("unmute <member> [reason]", "Restore voice to the silenced"),
-                ("purge <amount>", "Cleanse the chat of messages (1-100)"),
+                ("mutes", "View all silenced souls in the realm"),
+                ("massban <targets...> [reason]", "Exile many at once (IDs, mentions, id-id ranges, joined:N)"),
+                ("masskick <targets...> [reason]", "Banish many at once"),
+                ("massmute <duration> <targets...> [reason]", "Silence many at once"),
+                ("purge <amount> [filters]", "Cleanse the chat (user: match: attachments links bots within:)"),
             ],
             "📜 **Slash Commands - Setup**": [
                 ("/setlogchannel <channel>", "Set the royal chronicle channel"),
@@ -1169,7 +3126,7 @@ async def _help(ctx):
                 ("/kick <member> [reason]", "Banish a knave from the realm"),
                 ("/ban <member> [reason]", "Permanently exile a criminal"),
                 ("/mute <member> <duration> [reason]", "Silence a chatterer"),
-                ("/purge <amount>", "Cleanse the chat of messages"),
+                ("/purge <amount> [user]", "Cleanse the chat of messages"),
             ],
             "🔒 **Slash Commands - Chambers**": [
                 ("/seal [reason]", "Seal a channel to prevent messages"),
@@ -1220,7 +3177,7 @@ async def _help(ctx):
 async def set_log_channel_cmd(ctx, channel: discord.TextChannel):
     """Set the royal chronicle channel for all server logs"""
     try:
-        set_log_channel(ctx.guild.id, channel.id)
+        await change_log_channel(ctx.guild.id, channel.id, f"Chronicle channel moved by {ctx.author}")
         embed = medieval_response(
             f"The royal chronicles shall now be recorded in {channel.mention}!",
             success=True,
@@ -1236,16 +3193,195 @@ async def set_log_channel_cmd(ctx, channel: discord.TextChannel):
         test_embed.add_field(name="📺 Channel", value=channel.mention, inline=True)
         test_embed.add_field(name="👑 Authority", value=ctx.author.mention, inline=True)
         test_embed.set_footer(text="All server activities will be recorded henceforth!")
-        await channel.send(embed=test_embed)
+        await announce(channel, embed=test_embed)
     except Exception as e:
         await ctx.send(embed=medieval_response(f"Error setting chronicle channel: {str(e)}", success=False))
+@bot.command(name="setlogwebhook")
+@commands.has_permissions(manage_guild=True)
+@commands.guild_only()
+async def set_log_webhook_cmd(ctx, mode: str = "on"):
+    """Deliver the royal chronicles through a webhook (on/off)"""
+    try:
+        mode = mode.lower()
+        if mode not in ("on", "off"):
+            return await ctx.send(embed=medieval_response(
+                "Choose 'on' or 'off', good sir!",
+                success=False
+            ))
+        config = await get_guild_config(ctx.guild.id)
+        if config.log_webhook_url:
+            # Retire the old webhook either way so a stale one never lingers in the channel
+            await delete_log_webhook(config.log_webhook_url, f"Chronicle webhook replaced by {ctx.author}")
+            await run_db(set_log_webhook, ctx.guild.id, None)
+        if mode == "off":
+            return await ctx.send(embed=medieval_response(
+                "The royal chronicles shall be delivered by the bot's own hand once more!",
+                success=True
+            ))
+        log_channel = ctx.guild.get_channel(config.log_channel) if config.log_channel else None
+        if not log_channel:
+            return await ctx.send(embed=medieval_response(
+                "Set a chronicle channel first with !setlogchannel!",
+                success=False
+            ))
+        webhook = await log_channel.create_webhook(
+            name=LOG_WEBHOOK_NAME,
+            reason=f"Chronicle webhook enabled by {ctx.author}"
+        )
+        await run_db(set_log_webhook, ctx.guild.id, webhook.url)
+        await ctx.send(embed=medieval_response(
+            f"The royal chronicles in {log_channel.mention} shall now be delivered by a dedicated herald!",
+            success=True,
+            extra="Log traffic no longer competes with the Crown's commands."
+        ))
+    except discord.Forbidden:
+        await ctx.send(embed=medieval_response(
+            "I lack the power to appoint a herald in that chamber! (Manage Webhooks)",
+            success=False
+        ))
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error setting chronicle webhook: {str(e)}", success=False))
+@bot.command(name="raidguard")
+@commands.has_permissions(manage_guild=True)
+@commands.guild_only()
+async def raid_guard_cmd(ctx, threshold: str = None, window_seconds: int = 10, action: str = "alert"):
+    """Arm the raid guard: <joins> <seconds> <alert|seal|timeout>, or 'off'"""
+    try:
+        if threshold is None:
+            config = await get_guild_config(ctx.guild.id)
+            if not config.raid_threshold:
+                return await ctx.send(embed=medieval_response("The raid guard sleeps in this realm.", success=True))
+            return await ctx.send(embed=medieval_response(
+                f"The raid guard watches for {config.raid_threshold} joins within {config.raid_window} seconds "
+                f"and will **{config.raid_action}**.",
+                success=True
+            ))
+        if threshold.lower() == "off":
+            await run_db(set_raid_guard, ctx.guild.id, None, None, None)
+            return await ctx.send(embed=medieval_response("The raid guard stands down.", success=True))
+        action = action.lower()
+        if not threshold.isdigit() or not 2 <= int(threshold) <= 1000:
+            return await ctx.send(embed=medieval_response("The join threshold must be between 2 and 1000!", success=False))
+        if not 1 <= window_seconds <= 3600:
+            return await ctx.send(embed=medieval_response("The window must be between 1 and 3600 seconds!", success=False))
+        if action not in RAID_ACTIONS:
+            return await ctx.send(embed=medieval_response(
+                f"Choose a response: {', '.join(RAID_ACTIONS)}!",
+                success=False
+            ))
+        await run_db(set_raid_guard, ctx.guild.id, int(threshold), window_seconds, action)
+        await ctx.send(embed=medieval_response(
+            f"The raid guard now watches the gates: {threshold} joins within {window_seconds} seconds "
+            f"and it shall **{action}**!",
+            success=True,
+            extra="Alerts are proclaimed in the chronicle channel."
+        ))
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error arming the raid guard: {str(e)}", success=False))
+@bot.command(name="spamguard")
+@commands.has_permissions(manage_guild=True)
+@commands.guild_only()
+async def spam_guard_cmd(ctx, action: str = None):
+    """Set how floods and copy-paste spam are answered: delete, timeout, pillory or off"""
+    try:
+        if action is None:
+            config = await get_guild_config(ctx.guild.id)
+            return await ctx.send(embed=medieval_response(
+                f"The spam guard answers with **{config.spam_action}**." if config.spam_action
+                else "The spam guard sleeps in this realm.",
+                success=True
+            ))
+        action = action.lower()
+        if action not in SPAM_ACTIONS + ("off",):
+            return await ctx.send(embed=medieval_response(
+                f"Choose a response: {', '.join(SPAM_ACTIONS)} or off!",
+                success=False
+            ))
+        await run_db(set_spam_action, ctx.guild.id, None if action == "off" else action)
+        await ctx.send(embed=medieval_response(
+            "The spam guard stands down." if action == "off"
+            else f"Spammers shall now meet the royal **{action}**!",
+            success=True
+        ))
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error setting the spam guard: {str(e)}", success=False))
+@bot.group(name="filter", invoke_without_command=True)
+@commands.has_permissions(manage_guild=True)
+@commands.guild_only()
+async def filter_cmd(ctx):
+    """Manage the realm's forbidden words: add, remove, list"""
+    await ctx.send(embed=medieval_response(
+        "Use `!filter add <word or phrase>, ...`, `!filter remove <word or phrase>, ...` or `!filter list`.",
+        success=True
+    ))
+def parse_filter_patterns(text):
+    """Split a comma-separated list into normalised patterns"""
+    return {normalize_filter_pattern(part) for part in (text or "").split(",") if part.strip()}
+@filter_cmd.command(name="add")
+async def filter_add_cmd(ctx, *, patterns: str = None):
+    """Forbid words or phrases (comma-separated)"""
+    try:
+        new_patterns = parse_filter_patterns(patterns)
+        if not new_patterns:
+            return await ctx.send(embed=medieval_response("Name the words to forbid!", success=False))
+        if any(len(pattern) > WORD_FILTER_MAX_LENGTH for pattern in new_patterns):
+            return await ctx.send(embed=medieval_response(
+                f"No forbidden phrase may exceed {WORD_FILTER_MAX_LENGTH} characters!",
+                success=False
+            ))
+        config = await get_guild_config(ctx.guild.id)
+        added = new_patterns - config.banned_words
+        if len(config.banned_words) + len(added) > WORD_FILTER_LIMIT:
+            return await ctx.send(embed=medieval_response(
+                f"The realm may forbid at most {WORD_FILTER_LIMIT} words and phrases!",
+                success=False
+            ))
+        await run_db(update_word_filters, ctx.guild.id, add=sorted(added))
+        await ctx.send(embed=medieval_response(
+            f"**{len(added)}** words and phrases are now forbidden in this realm!",
+            success=True
+        ))
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error forbidding words: {str(e)}", success=False))
+@filter_cmd.command(name="remove")
+async def filter_remove_cmd(ctx, *, patterns: str = None):
+    """Lift the ban on words or phrases (comma-separated)"""
+    try:
+        config = await get_guild_config(ctx.guild.id)
+        removed = parse_filter_patterns(patterns) & config.banned_words
+        if not removed:
+            return await ctx.send(embed=medieval_response("None of those words are forbidden!", success=False))
+        await run_db(update_word_filters, ctx.guild.id, remove=sorted(removed))
+        await ctx.send(embed=medieval_response(
+            f"**{len(removed)}** words and phrases may be spoken once more!",
+            success=True
+        ))
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error lifting the ban: {str(e)}", success=False))
+@filter_cmd.command(name="list")
+async def filter_list_cmd(ctx):
+    """List the realm's forbidden words"""
+    try:
+        config = await get_guild_config(ctx.guild.id)
+        if not config.banned_words:
+            return await ctx.send(embed=medieval_response("No words are forbidden in this realm!", success=True))
+        listing = ", ".join(f"||{pattern}||" for pattern in sorted(config.banned_words))
+        embed = medieval_embed(
+            title="🚫 Forbidden Words",
+            description=listing[:4000] + ("..." if len(listing) > 4000 else ""),
+            color_name="red"
+        )
+        embed.add_field(name="Count", value=str(len(config.banned_words)), inline=True)
+        await ctx.send(embed=embed)
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error listing forbidden words: {str(e)}", success=False))
 @bot.command(name="psetchannel")
 @commands.has_permissions(manage_channels=True)
 @commands.guild_only()
 async def set_pillory_channel_cmd(ctx, channel: discord.TextChannel):
     """Set the pillory channel for public shaming"""
     try:
-        set_pillory_channel(ctx.guild.id, channel.id)
+        await run_db(set_pillory_channel, ctx.guild.id, channel.id)
         embed = medieval_response(
             f"The pillory shall now be erected in {channel.mention}!",
             success=True
@@ -1253,6 +3389,74 @@ async def set_pillory_channel_cmd(ctx, channel: discord.TextChannel):
         await ctx.send(embed=embed)
     except Exception as e:
         await ctx.send(embed=medieval_response(f"Error setting channel: {str(e)}", success=False))
+@bot.command(name="stats")
+@commands.has_permissions(manage_guild=True)
+@commands.guild_only()
+async def stats_cmd(ctx):
+    """Show the royal scribes' bookkeeping (caches and queues)"""
+    try:
+        embed = medieval_embed(
+            title="📊 Royal Ledger",
+            description="The state of the royal archives and messengers:",
+            color_name="teal"
+        )
+        embed.add_field(
+            name="📜 Message Cache",
+            value=(
+                f"**Entries:** {len(message_cache)} ({message_cache.bytes / 1048576:.1f} MB)\n"
+                f"**Hits:** {message_cache.hits} | **Misses:** {message_cache.misses} "
+                f"({message_cache.hit_rate:.0%} hit rate)\n"
+                f"**Evictions:** {message_cache.evictions}"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="✒️ Message Buffer",
+            value=f"**Awaiting the scribe:** {len(message_buffer)}\n**Dropped:** {message_buffer.dropped}",
+            inline=False
+        )
+        embed.add_field(
+            name="📨 Log Delivery",
+            value=(
+                f"**Queued:** {len(log_dispatcher)}\n"
+                f"**Sent:** {log_dispatcher.embeds_sent} entries in {log_dispatcher.messages_sent} messages "
+                f"({log_dispatcher.webhook_messages} by webhook)\n"
+                f"**Dropped:** {log_dispatcher.dropped} | **Failed:** {log_dispatcher.failed}"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="🚦 Royal Couriers",
+            value="\n".join(
+                f"**{name}:** {outbound.queued(priority)} waiting, {outbound.in_flight(priority)} riding, "
+                f"{outbound.completed[priority]} delivered"
+                for priority, name in PRIORITY_NAMES.items()
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="🛡️ Spam Guard",
+            value=f"**Members watched:** {len(spam_tracker)}\n**Spammers caught:** {spam_tracker.caught}",
+            inline=False
+        )
+        embed.add_field(
+            name="🗄️ Attachment Archive",
+            value=(
+                f"**Queued:** {len(attachment_archiver)} | **Stored:** {attachment_archiver.stored} "
+                f"| **Duplicates:** {attachment_archiver.duplicates}\n"
+                f"**Skipped:** {attachment_archiver.skipped} | **Dropped:** {attachment_archiver.dropped} "
+                f"| **Failed:** {attachment_archiver.failed}"
+            ) if attachment_archiver.enabled else "Disabled (set ATTACHMENT_ARCHIVE_DIR)",
+            inline=False
+        )
+        embed.add_field(
+            name="⏳ Royal Timers",
+            value=f"**Armed:** {len(expiry_scheduler)}\n**Fired:** {expiry_scheduler.fired}",
+            inline=False
+        )
+        await ctx.send(embed=embed)
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error reading the royal ledger: {str(e)}", success=False))
 # ---------- PILLORY COMMANDS ----------
 @bot.command(name="pbypass")
 @commands.has_permissions(administrator=True)
@@ -1266,7 +3470,7 @@ async def set_pillory_bypass_cmd(ctx, *roles: discord.Role):
                 success=False
             ))
         role_ids = [r.id for r in roles]
-        set_pillory_bypass_roles(ctx.guild.id, role_ids)
+        await run_db(set_pillory_bypass_roles, ctx.guild.id, role_ids)
         role_mentions = " ".join(r.mention for r in roles)
         embed = medieval_embed(
             title="👑 Royal Bypass Privilege",
@@ -1293,7 +3497,7 @@ async def set_pillory_allowed_roles_cmd(ctx, *roles: discord.Role):
                 success=False
             ))
         role_ids = [r.id for r in roles]
-        set_pillory_allowed_roles(ctx.guild.id, role_ids)
+        await run_db(set_pillory_allowed_roles, ctx.guild.id, role_ids)
         role_mentions = " ".join(r.mention for r in roles)
         embed = medieval_embed(
             title="⚔️ Royal Pillory Privileges",
@@ -1313,14 +3517,13 @@ async def set_pillory_allowed_roles_cmd(ctx, *roles: discord.Role):
 async def list_pillory_bypass_roles_cmd(ctx):
     """List roles with pillory bypass privilege"""
     try:
-        bypass_roles_str = get_pillory_bypass_roles(ctx.guild.id)
-        if not bypass_roles_str:
+        bypass_role_ids = (await get_guild_config(ctx.guild.id)).bypass_roles
+        if not bypass_role_ids:
             return await ctx.send(embed=medieval_response(
                 "No roles possess royal bypass privileges!",
                 success=True
             ))
-        bypass_role_ids = [int(r) for r in bypass_roles_str.split(',') if r]
-        roles = [ctx.guild.get_role(role_id) for role_id in bypass_role_ids if ctx.guild.get_role(role_id)]
+        roles = [role for role in map(ctx.guild.get_role, sorted(bypass_role_ids)) if role]
         if not roles:
             return await ctx.send(embed=medieval_response(
                 "The bypass roles exist no more!",
@@ -1340,14 +3543,13 @@ async def list_pillory_bypass_roles_cmd(ctx):
 async def list_pillory_allowed_roles_cmd(ctx):
     """List roles allowed to use pillory commands"""
     try:
-        allowed_roles_str = get_pillory_allowed_roles(ctx.guild.id)
-        if not allowed_roles_str:
+        allowed_role_ids = (await get_guild_config(ctx.guild.id)).allowed_roles
+        if not allowed_role_ids:
             return await ctx.send(embed=medieval_response(
                 "All subjects may use the pillory - no restrictions set!",
                 success=True
             ))
-        allowed_role_ids = [int(r) for r in allowed_roles_str.split(',') if r]
-        roles = [ctx.guild.get_role(role_id) for role_id in allowed_role_ids if ctx.guild.get_role(role_id)]
+        roles = [role for role in map(ctx.guild.get_role, sorted(allowed_role_ids)) if role]
         if not roles:
             return await ctx.send(embed=medieval_response(
                 "The privileged roles exist no more!",
@@ -1362,6 +3564,39 @@ async def list_pillory_allowed_roles_cmd(ctx):
         await ctx.send(embed=embed)
     except Exception as e:
         await ctx.send(embed=medieval_response(f"Error listing allowed roles: {str(e)}", success=False))
+async def place_in_pillory(guild, member, moderator, duration_minutes, reason, config):
+    """Sentence a member: record it, arm its expiry, add the role, proclaim it and book the bulletins"""
+    pillory_channel = guild.get_channel(config.pillory_channel) if config.pillory_channel else None
+    if not pillory_channel:
+        raise ValueError("The pillory channel exists not! Check thy settings.")
+    # Add pillory
+    pillory_id = await run_db(add_pillory, guild.id, member.id, duration_minutes, reason)
+    if not pillory_id:
+        raise ValueError("Failed to create pillory! Check database.")
+    expiry_scheduler.schedule("pillory", pillory_id, epoch_ms() + duration_minutes * 60000)
+    # Add pillory role if set
+    pillory_role = guild.get_role(config.pillory_role) if config.pillory_role else None
+    if pillory_role:
+        try:
+            await enforce(("member_roles", guild.id), member.add_roles, pillory_role)
+        except discord.Forbidden:
+            pass
+    # Create enhanced shame message with @here and royal seal
+    shame_message = random.choice(PILLORY_SHAME_MESSAGES).format(
+        user=member.display_name.upper(),
+        reason=reason,
+        duration=duration_minutes,
+        moderator=moderator.display_name.upper()
+    )
+    # Send the shame message first (as plain text for @here to work)
+    await announce(pillory_channel, shame_message)
+    # Add moderation log
+    await run_db(add_moderation_log, guild.id, moderator.id, member.id, "pillory", reason)
+    # Schedule updates if duration > 5 minutes
+    if duration_minutes > 5:
+        await run_db(add_scheduled_job, "pillory_update", guild.id, pillory_id,
+                     epoch_ms() + PILLORY_UPDATE_INTERVAL_MS)
+    return pillory_id
 @bot.command(name="pillory")
 @commands.guild_only()
 async def pillory_cmd(ctx, member: discord.Member, duration_minutes: int, *, reason: str):
@@ -1374,27 +3609,28 @@ async def pillory_cmd(ctx, member: discord.Member, duration_minutes: int, *, rea
                 "Thou hast not the royal privilege to command the pillory!",
                 success=False
             ))
+        config = await get_guild_config(ctx.guild.id)
         # Check if user can use pillory commands
-        if not can_use_pillory(ctx.guild.id, ctx.author.id):
+        if not can_use_pillory(config, ctx.author):
             return await ctx.send(embed=medieval_response(
                 "Thou hast not the royal privilege to command the pillory!",
                 success=False
             ))
         # Check if target has bypass
-        if has_pillory_bypass(ctx.guild.id, member.id):
+        if has_pillory_bypass(config, member):
             return await ctx.send(embed=medieval_response(
                 f"{member.display_name} possesses royal immunity from the pillory!",
                 success=False
             ))
         # Check if pillory channel is set
-        pillory_channel_id = get_pillory_channel(ctx.guild.id)
+        pillory_channel_id = config.pillory_channel
         if not pillory_channel_id:
             return await ctx.send(embed=medieval_response(
                 "No pillory channel hath been set! Use `!psetchannel` first.",
                 success=False
             ))
         # Check if user is already pilloried
-        existing_pillory = is_user_pilloried(ctx.guild.id, member.id)
+        existing_pillory = await run_db(is_user_pilloried, ctx.guild.id, member.id)
         if existing_pillory:
             return await ctx.send(embed=medieval_response(
                 f"{member.display_name} is already in the pillory!",
@@ -1406,71 +3642,10 @@ async def pillory_cmd(ctx, member: discord.Member, duration_minutes: int, *, rea
                 "Duration must be between 1 and 1440 minutes!",
                 success=False
             ))
-        # Add pillory
-        pillory_id = add_pillory(ctx.guild.id, member.id, duration_minutes, reason)
-        if not pillory_id:
-            return await ctx.send(embed=medieval_response(
-                "Failed to create pillory! Check database.",
-                success=False
-            ))
-        # Get pillory channel
-        pillory_channel = ctx.guild.get_channel(pillory_channel_id)
-        if not pillory_channel:
-            return await ctx.send(embed=medieval_response(
-                "The pillory channel exists not! Check thy settings.",
-                success=False
-            ))
-        # Add pillory role if set
-        pillory_role_id = get_pillory_role(ctx.guild.id)
-        if pillory_role_id:
-            pillory_role = ctx.guild.get_role(pillory_role_id)
-            if pillory_role:
-                try:
-                    await member.add_roles(pillory_role)
-                except discord.Forbidden:
-                    pass
-        # Create enhanced shame message with @here and royal seal
-        shame_message = random.choice(PILLORY_SHAME_MESSAGES).format(
-            user=member.display_name.upper(),
-            reason=reason,
-            duration=duration_minutes,
-            moderator=ctx.author.display_name.upper()
-        )
-        # Send the shame message first (as plain text for @here to work)
-        await pillory_channel.send(shame_message)
-        # Add moderation log
-        add_moderation_log(ctx.guild.id, ctx.author.id, member.id, "pillory", reason)
-        # Schedule updates if duration > 5 minutes
-        if duration_minutes > 5:
-            async def schedule_dramatic_updates():
-                try:
-                    remaining = duration_minutes
-                    update_count = 0
-                    while remaining > 0:
-                        await asyncio.sleep(300) # Wait 5 minutes
-                        remaining -= 5
-                        update_count += 1
-                        if remaining > 0:
-                            # Check if pillory is still active
-                            with get_db_connection() as db:
-                                row = db.execute("SELECT active FROM active_pillories WHERE id=?", (pillory_id,)).fetchone()
-                                if row and row[0] == 1:
-                                    # Create dramatic update with @here
-                                    update_message = random.choice(PILLORY_UPDATE_MESSAGES).format(
-                                        user=member.display_name.upper(),
-                                        reason=reason,
-                                        elapsed=update_count * 5,
-                                        remaining=remaining
-                                    )
-                                    await pillory_channel.send(update_message)
-                                    # Add extra insult for more shame
-                                    insult = random.choice(PILLORY_INSULTS_EXTENDED)
-                                    await pillory_channel.send(f"*{insult}*")
-                                else:
-                                    break
-                except Exception as e:
-                    print(f"Error in pillory updates: {e}")
-            bot.loop.create_task(schedule_dramatic_updates())
+        try:
+            await place_in_pillory(ctx.guild, member, ctx.author, duration_minutes, reason, config)
+        except ValueError as e:
+            return await ctx.send(embed=medieval_response(str(e), success=False))
         await ctx.send(embed=medieval_response(
             f"{member.display_name} hath been placed in the pillory for {duration_minutes} minutes by royal decree!",
             success=True
@@ -1482,7 +3657,7 @@ async def pillory_cmd(ctx, member: discord.Member, duration_minutes: int, *, rea
 async def list_pillories(ctx):
     """View active pillories in the realm"""
     try:
-        pillories = get_active_pillories(ctx.guild.id)
+        pillories = await run_db(get_active_pillories, ctx.guild.id)
         if not pillories:
             return await ctx.send(embed=medieval_response(
                 "The pillory stands empty this day!",
@@ -1496,17 +3671,12 @@ async def list_pillories(ctx):
         for pillory_id, user_id, start_time, end_time, reason in pillories:
             member = ctx.guild.get_member(user_id)
             if member:
-                try:
-                    end_dt = dt.fromisoformat(end_time).replace(tzinfo=timezone.utc)
-                    remaining = end_dt - utcnow()
-                    minutes_left = max(0, int(remaining.total_seconds() / 60))
-                    embed.add_field(
-                        name=f"Pillory #{pillory_id} - {member.display_name}",
-                        value=f"**Time left:** {minutes_left} minutes\n**Reason:** {reason}",
-                        inline=False
-                    )
-                except ValueError:
-                    pass
+                minutes_left = max(0, (end_time - epoch_ms()) // 60000) if end_time is not None else 0
+                embed.add_field(
+                    name=f"Pillory #{pillory_id} - {member.display_name}",
+                    value=f"**Time left:** {minutes_left} minutes\n**Reason:** {reason}",
+                    inline=False
+                )
         await ctx.send(embed=embed)
     except Exception as e:
         await ctx.send(embed=medieval_response(f"Error listing pillories: {str(e)}", success=False))
@@ -1515,42 +3685,41 @@ async def list_pillories(ctx):
 async def pardon_cmd(ctx, pillory_id: int):
     """Show mercy and end a pillory early with royal ceremony"""
     try:
-        with get_db_connection() as db:
-            row = db.execute("SELECT user_id, active FROM active_pillories WHERE id=? AND guild_id=?",
-                            (pillory_id, ctx.guild.id)).fetchone()
-            if not row:
-                return await ctx.send(embed=medieval_response(
-                    f"No pillory with ID #{pillory_id} exists!",
-                    success=False
-                ))
-            user_id, active = row
-            if not active:
-                return await ctx.send(embed=medieval_response(
-                    f"Pillory #{pillory_id} is already ended!",
-                    success=False
-                ))
-            # Check permissions
-            if not ctx.author.guild_permissions.moderate_members:
-                return await ctx.send(embed=medieval_response(
-                    "Thou hast not the authority to grant pardons!",
-                    success=False
-                ))
-            # End the pillory
-            db.execute("UPDATE active_pillories SET active=0 WHERE id=?", (pillory_id,))
-            db.commit()
+        row = await run_db(get_pillory, pillory_id, ctx.guild.id)
+        if not row:
+            return await ctx.send(embed=medieval_response(
+                f"No pillory with ID #{pillory_id} exists!",
+                success=False
+            ))
+        user_id, active = row
+        if not active:
+            return await ctx.send(embed=medieval_response(
+                f"Pillory #{pillory_id} is already ended!",
+                success=False
+            ))
+        # Check permissions
+        if not ctx.author.guild_permissions.moderate_members:
+            return await ctx.send(embed=medieval_response(
+                "Thou hast not the authority to grant pardons!",
+                success=False
+            ))
+        # End the pillory
+        await run_db(end_pillory, pillory_id)
+        expiry_scheduler.cancel("pillory", pillory_id)
         # Remove pillory role if set
-        pillory_role_id = get_pillory_role(ctx.guild.id)
+        config = await get_guild_config(ctx.guild.id)
+        pillory_role_id = config.pillory_role
         if pillory_role_id:
             pillory_role = ctx.guild.get_role(pillory_role_id)
             if pillory_role:
                 member = ctx.guild.get_member(user_id)
                 if member:
                     try:
-                        await member.remove_roles(pillory_role)
+                        await enforce(("member_roles", ctx.guild.id), member.remove_roles, pillory_role)
                     except discord.Forbidden:
                         pass
         # Get pillory channel and announce pardon with ceremony
-        pillory_channel_id = get_pillory_channel(ctx.guild.id)
+        pillory_channel_id = config.pillory_channel
         if pillory_channel_id:
             pillory_channel = ctx.guild.get_channel(pillory_channel_id)
             if pillory_channel:
@@ -1577,7 +3746,7 @@ By special dispensation and royal prerogative, {ctx.author.mention} hath granted
 **SO DECREES THE CROWN!** ⚖️"""
                     ]
                     pardon_message = random.choice(pardon_ceremonies)
-                    await pillory_channel.send(pardon_message)
+                    await announce(pillory_channel, pardon_message)
         await ctx.send(embed=medieval_response(
             f"Pillory #{pillory_id} hath been ended by royal pardon!",
             success=True
@@ -1600,7 +3769,7 @@ async def warn_cmd(ctx, member: discord.Member, *, reason: str):
                 "Thou cannot warn thyself!",
                 success=False
             ))
-        add_warning(ctx.guild.id, member.id, ctx.author.id, reason)
+        await run_db(add_warning, ctx.guild.id, member.id, ctx.author.id, reason)
         embed = medieval_embed(
             title="⚠️ Royal Warning",
             description=f"{member.mention} hath been warned by {ctx.author.mention}!",
@@ -1617,7 +3786,7 @@ async def warn_cmd(ctx, member: discord.Member, *, reason: str):
             )
             dm_embed.add_field(name="Reason", value=reason, inline=False)
             dm_embed.add_field(name="Moderator", value=ctx.author.display_name, inline=False)
-            await member.send(embed=dm_embed)
+            await announce(member, embed=dm_embed)
         except:
             pass
     except Exception as e:
@@ -1628,7 +3797,7 @@ async def warnings_cmd(ctx, member: discord.Member = None):
     """Check warnings for a subject"""
     try:
         member = member or ctx.author
-        warnings = get_warnings(ctx.guild.id, member.id)
+        warnings = await run_db(get_warnings, ctx.guild.id, member.id)
         if not warnings:
             return await ctx.send(embed=medieval_response(
                 f"{member.display_name} hath a clean record!",
@@ -1642,11 +3811,7 @@ async def warnings_cmd(ctx, member: discord.Member = None):
         for i, (moderator_id, reason, timestamp) in enumerate(warnings[:5]):
             moderator = ctx.guild.get_member(moderator_id)
             mod_name = moderator.display_name if moderator else f"Moderator {moderator_id}"
-            try:
-                warn_time = dt.fromisoformat(timestamp).replace(tzinfo=timezone.utc)
-                time_str = f"<t:{int(warn_time.timestamp())}:R>"
-            except ValueError:
-                time_str = "Unknown time"
+            time_str = discord_timestamp(timestamp)
             embed.add_field(
                 name=f"Warning #{i+1}",
                 value=f"**By:** {mod_name}\n**When:** {time_str}\n**Reason:** {reason}",
@@ -1671,9 +3836,7 @@ async def clearwarn_cmd(ctx, member: discord.Member):
                 "Thou hast not the authority to clear warnings!",
                 success=False
             ))
-        with get_db_connection() as db:
-            db.execute("DELETE FROM warnings WHERE guild_id=? AND user_id=?", (ctx.guild.id, member.id))
-            db.commit()
+        await run_db(clear_warnings, ctx.guild.id, member.id)
         await ctx.send(embed=medieval_response(
             f"All warnings for {member.display_name} have been cleared!",
             success=True
@@ -1701,7 +3864,7 @@ async def kick_cmd(ctx, member: discord.Member, *, reason: str = None):
                 "Thou cannot banish one of equal or higher station!",
                 success=False
             ))
-        await member.kick(reason=reason)
+        await enforce(("kick", ctx.guild.id), member.kick, reason=reason)
         embed = medieval_embed(
             title="⚔️ Banishment",
             description=f"{member.display_name} hath been banished from the realm!",
@@ -1710,7 +3873,7 @@ async def kick_cmd(ctx, member: discord.Member, *, reason: str = None):
         if reason:
             embed.add_field(name="Reason", value=reason, inline=False)
         await ctx.send(embed=embed)
-        add_moderation_log(ctx.guild.id, ctx.author.id, member.id, "kick", reason or "No reason given")
+        await run_db(add_moderation_log, ctx.guild.id, ctx.author.id, member.id, "kick", reason or "No reason given")
     except discord.Forbidden:
         await ctx.send(embed=medieval_response(
             "I lack the power to banish this soul!",
@@ -1738,7 +3901,7 @@ async def ban_cmd(ctx, member: discord.Member, *, reason: str = None):
                 "Thou cannot exile one of equal or higher station!",
                 success=False
             ))
-        await member.ban(reason=reason)
+        await enforce(("ban", ctx.guild.id), member.ban, reason=reason)
         embed = medieval_embed(
             title="🔨 Eternal Exile",
             description=f"{member.display_name} hath been forever exiled from the realm!",
@@ -1747,7 +3910,7 @@ async def ban_cmd(ctx, member: discord.Member, *, reason: str = None):
         if reason:
             embed.add_field(name="Reason", value=reason, inline=False)
         await ctx.send(embed=embed)
-        add_moderation_log(ctx.guild.id, ctx.author.id, member.id, "ban", reason or "No reason given")
+        await run_db(add_moderation_log, ctx.guild.id, ctx.author.id, member.id, "ban", reason or "No reason given")
     except discord.Forbidden:
         await ctx.send(embed=medieval_response(
             "I lack the power to exile this soul!",
@@ -1766,7 +3929,7 @@ async def unban_cmd(ctx, user_id: str, *, reason: str = None):
                 success=False
             ))
         user = await bot.fetch_user(int(user_id))
-        await ctx.guild.unban(user, reason=reason)
+        await enforce(("ban", ctx.guild.id), ctx.guild.unban, user, reason=reason)
         embed = medieval_embed(
             title="⚖️ Royal Pardon",
             description=f"{user.display_name} hath been granted pardon and may return to the realm!",
@@ -1775,7 +3938,7 @@ async def unban_cmd(ctx, user_id: str, *, reason: str = None):
         if reason:
             embed.add_field(name="Reason", value=reason, inline=False)
         await ctx.send(embed=embed)
-        add_moderation_log(ctx.guild.id, ctx.author.id, user.id, "unban", reason or "Royal pardon")
+        await run_db(add_moderation_log, ctx.guild.id, ctx.author.id, user.id, "unban", reason or "Royal pardon")
     except discord.NotFound:
         await ctx.send(embed=medieval_response(
             "This exile exists not in our records!",
@@ -1814,7 +3977,10 @@ async def mute_cmd(ctx, member: discord.Member, duration_minutes: int, *, reason
                 success=False
             ))
         duration = timedelta(minutes=duration_minutes)
-        await member.timeout(duration, reason=reason)
+        await enforce(("member", ctx.guild.id), member.timeout, duration, reason=reason)
+        end_time = epoch_ms() + duration_minutes * 60000
+        mute_id = await run_db(add_mute, ctx.guild.id, member.id, ctx.author.id, end_time, reason)
+        expiry_scheduler.schedule("mute", mute_id, end_time)
         embed = medieval_embed(
             title="🔇 Silenced",
             description=f"{member.display_name} hath been silenced for {duration_minutes} minutes!",
@@ -1823,7 +3989,7 @@ async def mute_cmd(ctx, member: discord.Member, duration_minutes: int, *, reason
         if reason:
             embed.add_field(name="Reason", value=reason, inline=False)
         await ctx.send(embed=embed)
-        add_moderation_log(ctx.guild.id, ctx.author.id, member.id, "mute", reason or f"Muted for {duration_minutes} minutes")
+        await run_db(add_moderation_log, ctx.guild.id, ctx.author.id, member.id, "mute", reason or f"Muted for {duration_minutes} minutes")
     except discord.Forbidden:
         await ctx.send(embed=medieval_response(
             "I lack the power to silence this soul!",
@@ -1841,7 +4007,8 @@ async def unmute_cmd(ctx, member: discord.Member, *, reason: str = None):
                 "Thou hast not the authority to restore voices!",
                 success=False
             ))
-        await member.timeout(None, reason=reason)
+        await enforce(("member", ctx.guild.id), member.timeout, None, reason=reason)
+        await run_db(end_member_mutes, ctx.guild.id, member.id)
         embed = medieval_embed(
             title="🔊 Voice Restored",
             description=f"{member.display_name} may speak once more!",
@@ -1850,7 +4017,7 @@ async def unmute_cmd(ctx, member: discord.Member, *, reason: str = None):
         if reason:
             embed.add_field(name="Reason", value=reason, inline=False)
         await ctx.send(embed=embed)
-        add_moderation_log(ctx.guild.id, ctx.author.id, member.id, "unmute", reason or "Mute lifted")
+        await run_db(add_moderation_log, ctx.guild.id, ctx.author.id, member.id, "unmute", reason or "Mute lifted")
     except discord.Forbidden:
         await ctx.send(embed=medieval_response(
             "I cannot restore this soul's voice!",
@@ -1858,30 +4025,366 @@ async def unmute_cmd(ctx, member: discord.Member, *, reason: str = None):
         ))
     except Exception as e:
         await ctx.send(embed=medieval_response(f"Error restoring voice: {str(e)}", success=False))
+@bot.command(name="mutes")
+@commands.guild_only()
+async def list_mutes_cmd(ctx):
+    """View all silenced souls in the realm"""
+    try:
+        mutes = await run_db(get_active_mutes, ctx.guild.id)
+        if not mutes:
+            return await ctx.send(embed=medieval_response(
+                "No soul is silenced this day!",
+                success=True
+            ))
+        embed = medieval_embed(
+            title="🔇 Silenced Souls",
+            description=f"There are **{len(mutes)}** souls under the royal gag:",
+            color_name="orange"
+        )
+        for mute_id, user_id, moderator_id, end_time, reason in mutes[:20]:
+            member = ctx.guild.get_member(user_id)
+            moderator = ctx.guild.get_member(moderator_id) if moderator_id else None
+            embed.add_field(
+                name=f"#{mute_id} - {member.display_name if member else f'User {user_id}'}",
+                value=(
+                    f"**Speaks again:** {discord_timestamp(end_time)}\n"
+                    f"**By:** {moderator.mention if moderator else 'Unknown'}\n"
+                    f"**Reason:** {reason or 'No reason given'}"
+                ),
+                inline=False
+            )
+        if len(mutes) > 20:
+            embed.add_field(
+                name="ℹ️ Note",
+                value=f"Showing the 20 soonest of {len(mutes)} mutes",
+                inline=False
+            )
+        await ctx.send(embed=embed)
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error listing the silenced: {str(e)}", success=False))
+# Mass Moderation Commands
+MASS_ACTION_LIMIT = int(os.getenv("MASS_ACTION_LIMIT", "200"))
+MASS_ACTION_CONCURRENCY = int(os.getenv("MASS_ACTION_CONCURRENCY", "5"))
+MASS_TARGET_RANGE = re.compile(r"^(\d{15,20})-(\d{15,20})$")
+MASS_TARGET_ID = re.compile(r"^(?:<@!?)?(\d{15,20})>?$")
+MASS_TARGET_JOINED = re.compile(r"^joined:(\d+)$", re.IGNORECASE)
+def parse_mass_targets(guild, text):
+    """Split '<targets...> [reason]' into target user ids and the reason"""
+    # Targets are mentions or ids, first-last id ranges (cached members only) and joined:N minutes;
+    # the reason starts at the first word that is none of these
+    words = (text or "").split()
+    target_ids = {}
+    consumed = 0
+    for word in words:
+        if match := MASS_TARGET_RANGE.match(word):
+            low, high = sorted((int(match.group(1)), int(match.group(2))))
+            for member in guild.members:
+                if low <= member.id <= high:
+                    target_ids[member.id] = None
+        elif match := MASS_TARGET_ID.match(word):
+            target_ids[int(match.group(1))] = None
+        elif match := MASS_TARGET_JOINED.match(word):
+            since = utcnow() - timedelta(minutes=int(match.group(1)))
+            for member in guild.members:
+                if member.joined_at and member.joined_at >= since:
+                    target_ids[member.id] = None
+        else:
+            break
+        consumed += 1
+    return list(target_ids), " ".join(words[consumed:]) or None
+def mass_target_refusal(ctx, user_id, member):
+    """Why a target may not be struck, or None"""
+    if user_id == ctx.author.id:
+        return "that is thee"
+    if user_id == bot.user.id:
+        return "that is me"
+    if member is None:
+        return None
+    if member.id == ctx.guild.owner_id:
+        return "the sovereign of this realm"
+    if member.top_role >= ctx.author.top_role:
+        return "equal or higher station"
+    if member.top_role >= ctx.guild.me.top_role:
+        return "above my station"
+    return None
+async def run_mass_action(ctx, action, text, strike, needs_member=True, mute_minutes=None):
+    """Shared driver for the mass commands: parse, vet, strike with bounded concurrency, record, report"""
+    target_ids, reason = parse_mass_targets(ctx.guild, text)
+    if not target_ids:
+        return await ctx.send(embed=medieval_response(
+            "Name thy targets: mentions, IDs, ID ranges (first-last) or joined:<minutes>!",
+            success=False
+        ))
+    if len(target_ids) > MASS_ACTION_LIMIT:
+        return await ctx.send(embed=medieval_response(
+            f"{len(target_ids)} targets! The Crown permits at most {MASS_ACTION_LIMIT} in one decree.",
+            success=False
+        ))
+    reason = reason or f"Mass {action} by {ctx.author}"
+    results = {}
+    pending = []
+    for user_id in target_ids:
+        member = ctx.guild.get_member(user_id)
+        refusal = mass_target_refusal(ctx, user_id, member)
+        if refusal is None and needs_member and member is None:
+            refusal = "not in the realm"
+        if refusal:
+            results[user_id] = f"❌ skipped: {refusal}"
+        else:
+            pending.append((user_id, member))
+    outcomes = await gather_bounded(
+        [strike(user_id, member, reason) for user_id, member in pending],
+        limit=MASS_ACTION_CONCURRENCY
+    )
+    struck = []
+    for (user_id, member), outcome in zip(pending, outcomes):
+        if isinstance(outcome, discord.Forbidden):
+            results[user_id] = "❌ forbidden"
+        elif isinstance(outcome, discord.NotFound):
+            results[user_id] = "❌ no such user"
+        elif isinstance(outcome, Exception):
+            results[user_id] = f"❌ {outcome}"
+        else:
+            results[user_id] = "✅"
+            struck.append(user_id)
+    if struck:
+        end_time = epoch_ms() + mute_minutes * 60000 if mute_minutes else None
+        mute_ids = await run_db(record_mass_moderation, ctx.guild.id, ctx.author.id, action, reason, struck, end_time)
+        for mute_id in mute_ids.values():
+            expiry_scheduler.schedule("mute", mute_id, end_time)
+    lines = []
+    for user_id in target_ids:
+        member = ctx.guild.get_member(user_id)
+        name = f"{member.display_name} ({user_id})" if member else str(user_id)
+        lines.append(f"{results[user_id]} {name}")
+    embed = medieval_embed(
+        title=f"⚔️ Mass {action.title()}",
+        description=f"**{len(struck)}** of **{len(target_ids)}** targets struck by royal decree!",
+        color_name="red" if struck else "orange"
+    )
+    embed.add_field(name="Reason", value=reason[:1024], inline=False)
+    report = "\n".join(lines)
+    if len(report) <= 1024:
+        embed.add_field(name="Results", value=report, inline=False)
+        await ctx.send(embed=embed)
+    else:
+        await ctx.send(embed=embed, file=discord.File(BytesIO(report.encode()), filename=f"mass_{action}.txt"))
+@bot.command(name="massban")
+@commands.guild_only()
+async def massban_cmd(ctx, *, targets: str = None):
+    """Exile many criminals at once (mentions, IDs, ID ranges, joined:N)"""
+    try:
+        if not ctx.author.guild_permissions.ban_members:
+            return await ctx.send(embed=medieval_response(
+                "Thou hast not the authority to exile souls!",
+                success=False
+            ))
+        async def strike(user_id, member, reason):
+            # Bans work by ID, so raiders who already left are caught too
+            await enforce_in_bulk(ctx.guild.ban, member or discord.Object(id=user_id), reason=reason)
+        await run_mass_action(ctx, "ban", targets, strike, needs_member=False)
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error exiling: {str(e)}", success=False))
+@bot.command(name="masskick")
+@commands.guild_only()
+async def masskick_cmd(ctx, *, targets: str = None):
+    """Banish many knaves at once (mentions, IDs, ID ranges, joined:N)"""
+    try:
+        if not ctx.author.guild_permissions.kick_members:
+            return await ctx.send(embed=medieval_response(
+                "Thou hast not the authority to banish souls!",
+                success=False
+            ))
+        async def strike(user_id, member, reason):
+            await enforce_in_bulk(member.kick, reason=reason)
+        await run_mass_action(ctx, "kick", targets, strike)
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error banishing: {str(e)}", success=False))
+@bot.command(name="massmute")
+@commands.guild_only()
+async def massmute_cmd(ctx, duration_minutes: int, *, targets: str = None):
+    """Silence many chatterers at once (mentions, IDs, ID ranges, joined:N)"""
+    try:
+        if not ctx.author.guild_permissions.moderate_members:
+            return await ctx.send(embed=medieval_response(
+                "Thou hast not the authority to silence souls!",
+                success=False
+            ))
+        if duration_minutes < 1 or duration_minutes > 40320: # Max 28 days
+            return await ctx.send(embed=medieval_response(
+                "Duration must be between 1 and 40320 minutes!",
+                success=False
+            ))
+        duration = timedelta(minutes=duration_minutes)
+        async def strike(user_id, member, reason):
+            await enforce_in_bulk(member.timeout, duration, reason=reason)
+        await run_mass_action(ctx, "mute", targets, strike, mute_minutes=duration_minutes)
+    except Exception as e:
+        await ctx.send(embed=medieval_response(f"Error silencing: {str(e)}", success=False))
+# Purge Engine
+PURGE_MAX_MESSAGES = int(os.getenv("PURGE_MAX_MESSAGES", "1000"))
+PURGE_SCAN_LIMIT = int(os.getenv("PURGE_SCAN_LIMIT", "10000")) # History read per purge, matching or not
+PURGE_SINGLE_DELETE_PAUSE = float(os.getenv("PURGE_SINGLE_DELETE_PAUSE", "1.0")) # Seconds between deletes of old messages
+PURGE_PROGRESS_SECONDS = 3
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5) # Discord refuses bulk deletes past 14 days
+LINK_PATTERN = re.compile(r"https?://|discord(?:\.gg|app\.com/invite)/", re.IGNORECASE)
+def parse_purge_filters(text):
+    """Parse 'user:<who> match:<regex> attachments links bots within:<minutes>' into (checks, window start, summary)"""
+    checks = []
+    summary = []
+    window_start = None
+    for token in shlex.split(text or ""):
+        key, _, value = token.partition(":")
+        key = key.lower()
+        if key == "user" and value:
+            user_match = MASS_TARGET_ID.match(value)
+            if not user_match:
+                raise ValueError(f"'{value}' is no subject I know!")
+            user_id = int(user_match.group(1))
+            checks.append(lambda message, user_id=user_id: message.author.id == user_id)
+            summary.append(f"from <@{user_id}>")
+        elif key == "match" and value:
+            try:
+                pattern = re.compile(value, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"That pattern is malformed: {e}")
+            checks.append(lambda message, pattern=pattern: bool(pattern.search(message.content)))
+            summary.append(f"matching `{value}`")
+        elif key == "attachments":
+            checks.append(lambda message: bool(message.attachments))
+            summary.append("with attachments")
+        elif key == "links":
+            checks.append(lambda message: bool(LINK_PATTERN.search(message.content)))
+            summary.append("with links")
+        elif key == "bots":
+            checks.append(lambda message: message.author.bot)
+            summary.append("from bots")
+        elif key == "within" and value.isdigit():
+            window_start = utcnow() - timedelta(minutes=int(value))
+            summary.append(f"from the last {value} minutes")
+        else:
+            raise ValueError(f"Unknown purge filter '{token}'!")
+    return checks, window_start, ", ".join(summary) or "all messages"
+async def delete_old_messages(channel, messages):
+    """Delete messages too old for bulk deletion one at a time, paced to stay clear of the rate limit"""
+    deleted = 0
+    for message in messages:
+        try:
+            await enforce(("message_delete", channel.id), message.delete)
+            deleted += 1
+        except discord.NotFound:
+            pass
+        await asyncio.sleep(PURGE_SINGLE_DELETE_PAUSE)
+    return deleted
+async def purge_channel(channel, amount, checks, window_start=None, skip_ids=(), progress=None):
+    """Stream history newest-first and delete up to `amount` matching messages; returns (bulk, single, scanned)"""
+    bulk_cutoff = utcnow() - BULK_DELETE_MAX_AGE
+    chunk = []
+    old = []
+    bulk_deleted = scanned = 0
+    async for message in channel.history(limit=PURGE_SCAN_LIMIT, after=window_start, oldest_first=False):
+        scanned += 1
+        if message.id in skip_ids or message.pinned or not all(check(message) for check in checks):
+            continue
+        if message.created_at > bulk_cutoff:
+            chunk.append(message)
+        else:
+            old.append(message)
+        if len(chunk) == 100:
+            await enforce(("bulk_delete", channel.id), channel.delete_messages, chunk)
+            bulk_deleted += len(chunk)
+            chunk = []
+            if progress:
+                await progress(bulk_deleted, scanned)
+        if bulk_deleted + len(chunk) + len(old) >= amount:
+            break
+    if chunk:
+        await enforce(("bulk_delete", channel.id), channel.delete_messages, chunk)
+        bulk_deleted += len(chunk)
+    if old and progress:
+        await progress(bulk_deleted, scanned, remaining_old=len(old))
+    single_deleted = await delete_old_messages(channel, old)
+    return bulk_deleted, single_deleted, scanned
 @bot.command(name="purge")
 @commands.guild_only()
-async def purge_cmd(ctx, amount: int):
-    """Cleanse the chat of messages"""
+async def purge_cmd(ctx, amount: int, *, filters: str = None):
+    """Cleanse the chat of messages, optionally filtered"""
     try:
         if not ctx.author.guild_permissions.manage_messages:
             return await ctx.send(embed=medieval_response(
                 "Thou hast not the authority to cleanse messages!",
                 success=False
             ))
-        if amount < 1 or amount > 100:
+        if amount < 1 or amount > PURGE_MAX_MESSAGES:
+            return await ctx.send(embed=medieval_response(
+                f"Thou mayest purge between 1 and {PURGE_MAX_MESSAGES} messages!",
+                success=False
+            ))
+        try:
+            checks, window_start, summary = parse_purge_filters(filters)
+        except ValueError as e:
             return await ctx.send(embed=medieval_response(
-                "Thou mayest purge between 1 and 100 messages!",
+                f"{e} Filters: user:<member> match:<regex> attachments links bots within:<minutes>",
                 success=False
             ))
-        deleted = await ctx.channel.purge(limit=amount + 1) # +1 for the command message
+        started = time.perf_counter()
+        command_message = getattr(ctx, "message", None)
+        if command_message:
+            try:
+                await command_message.delete()
+            except discord.HTTPException:
+                pass
+        status = await ctx.send(embed=medieval_embed(
+            title="🧹 Cleansing Underway",
+            description=f"Purging up to **{amount}** messages ({summary})...",
+            color_name="yellow"
+        ))
+        last_update = time.perf_counter()
+        async def progress(deleted, scanned, remaining_old=0):
+            nonlocal last_update
+            if not status or (not remaining_old and time.perf_counter() - last_update < PURGE_PROGRESS_SECONDS):
+                return
+            last_update = time.perf_counter()
+            note = f"\n**{remaining_old}** older messages must be struck one by one..." if remaining_old else ""
+            try:
+                await outbound.run(PRIORITY_REPLY, ("channel", ctx.channel.id), status.edit, embed=medieval_embed(
+                    title="🧹 Cleansing Underway",
+                    description=f"**{deleted}** purged of **{scanned}** scrolls read ({summary}).{note}",
+                    color_name="yellow"
+                ))
+            except discord.HTTPException:
+                pass
+        bulk_deleted, single_deleted, scanned = await purge_channel(
+            ctx.channel, amount, checks, window_start,
+            skip_ids={status.id} if status else set(),
+            progress=progress
+        )
+        deleted = bulk_deleted + single_deleted
+        elapsed = time.perf_counter() - started
         embed = medieval_embed(
             title="🧹 Chat Cleansed",
-            description=f"**{len(deleted) - 1}** messages have been purged from the records!",
+            description=f"**{deleted}** messages have been purged from the records!",
             color_name="green"
         )
-        msg = await ctx.send(embed=embed)
-        await asyncio.sleep(5)
-        await msg.delete()
+        await send_log_embed(
+            ctx.guild,
+            "purge",
+            "🧹 Chat Cleansed",
+            f"{ctx.author.mention} purged **{deleted}** messages in {ctx.channel.mention}.",
+            fields=[
+                ("🔎 Filter", summary[:1024], False),
+                ("📦 Bulk / Single", f"{bulk_deleted} / {single_deleted}", True),
+                ("📜 Scanned", str(scanned), True),
+                ("⏱️ Took", f"{elapsed:.1f}s", True)
+            ],
+            color="orange"
+        )
+        if status:
+            await outbound.run(PRIORITY_REPLY, ("channel", ctx.channel.id), status.edit, embed=embed)
+            await asyncio.sleep(5)
+            await status.delete()
+        else:
+            await ctx.send(embed=embed)
     except discord.Forbidden:
         await ctx.send(embed=medieval_response(
             "I lack the power to cleanse these messages!",
@@ -1901,7 +4404,7 @@ async def seal_channel_cmd(ctx, *, reason: str = "By royal decree"):
                 success=False
             ))
         # Check if channel is already sealed
-        existing_lock = is_channel_locked(ctx.guild.id, ctx.channel.id)
+        existing_lock = await run_db(is_channel_locked, ctx.guild.id, ctx.channel.id)
         if existing_lock:
             return await ctx.send(embed=medieval_response(
                 "This chamber is already sealed by royal decree!",
@@ -1919,7 +4422,9 @@ async def seal_channel_cmd(ctx, *, reason: str = "By royal decree"):
             ))
         # Seal the channel - deny send_messages to @everyone
         try:
-            await channel.set_permissions(
+            await enforce(
+                ("channel_permissions", channel.id),
+                channel.set_permissions,
                 everyone_role,
                 send_messages=False,
                 reason=f"Channel sealed by {ctx.author.display_name}: {reason}"
@@ -1930,7 +4435,7 @@ async def seal_channel_cmd(ctx, *, reason: str = "By royal decree"):
                 success=False
             ))
         # Record the lock in database
-        lock_id = lock_channel(ctx.guild.id, ctx.channel.id, ctx.author.id, reason)
+        lock_id = await run_db(lock_channel, ctx.guild.id, ctx.channel.id, ctx.author.id, reason)
         # Create dramatic announcement
         lock_message = random.choice(MEDIEVAL_LOCK_MESSAGES).format(
             channel=channel.mention,
@@ -1939,7 +4444,7 @@ async def seal_channel_cmd(ctx, *, reason: str = "By royal decree"):
         )
         await ctx.send(lock_message)
         # Add moderation log
-        add_moderation_log(ctx.guild.id, ctx.author.id, None, "channel_lock", reason)
+        await run_db(add_moderation_log, ctx.guild.id, ctx.author.id, None, "channel_lock", reason)
         # Create follow-up embed with royal seal
         embed = medieval_embed(
             title="🔒 Chamber Sealed",
@@ -1963,7 +4468,7 @@ async def unseal_channel_cmd(ctx, *, reason: str = "By royal mercy"):
                 success=False
             ))
         # Check if channel is sealed
-        lock_id = is_channel_locked(ctx.guild.id, ctx.channel.id)
+        lock_id = await run_db(is_channel_locked, ctx.guild.id, ctx.channel.id)
         if not lock_id:
             return await ctx.send(embed=medieval_response(
                 "This chamber is not sealed!",
@@ -1974,7 +4479,9 @@ async def unseal_channel_cmd(ctx, *, reason: str = "By royal mercy"):
         # Restore send_messages permission
         try:
             # Reset to default (None means inherit from category/server)
-            await channel.set_permissions(
+            await enforce(
+                ("channel_permissions", channel.id),
+                channel.set_permissions,
                 everyone_role,
                 send_messages=None, # Reset to default
                 reason=f"Channel unsealed by {ctx.author.display_name}: {reason}"
@@ -1985,7 +4492,7 @@ async def unseal_channel_cmd(ctx, *, reason: str = "By royal mercy"):
                 success=False
             ))
         # Update database
-        unlock_channel(lock_id, reason)
+        await run_db(unlock_channel, lock_id, reason)
         # Create dramatic announcement
         unlock_message = random.choice(MEDIEVAL_UNLOCK_MESSAGES).format(
             channel=channel.mention,
@@ -1994,7 +4501,7 @@ async def unseal_channel_cmd(ctx, *, reason: str = "By royal mercy"):
         )
         await ctx.send(unlock_message)
         # Add moderation log
-        add_moderation_log(ctx.guild.id, ctx.author.id, None, "channel_unlock", reason)
+        await run_db(add_moderation_log, ctx.guild.id, ctx.author.id, None, "channel_unlock", reason)
         # Create follow-up embed with royal seal
         embed = medieval_embed(
             title="🔓 Chamber Unsealed",
@@ -2012,7 +4519,7 @@ async def unseal_channel_cmd(ctx, *, reason: str = "By royal mercy"):
 async def list_sealed_channels_cmd(ctx):
     """📋 List all sealed channels in the realm"""
     try:
-        locked_channels = get_locked_channels(ctx.guild.id)
+        locked_channels = await run_db(get_locked_channels, ctx.guild.id)
         if not locked_channels:
             return await ctx.send(embed=medieval_response(
                 "No chambers are sealed in this realm!",
@@ -2027,11 +4534,7 @@ async def list_sealed_channels_cmd(ctx):
             channel = ctx.guild.get_channel(channel_id)
             moderator = ctx.guild.get_member(moderator_id)
             if channel and moderator:
-                try:
-                    lock_time = dt.fromisoformat(timestamp).replace(tzinfo=timezone.utc)
-                    time_str = f"<t:{int(lock_time.timestamp())}:R>"
-                except ValueError:
-                    time_str = "Unknown time"
+                time_str = discord_timestamp(timestamp)
                 embed.add_field(
                     name=f"🔒 {channel.name}",
                     value=f"**Sealed by:** {moderator.mention}\n**When:** {time_str}\n**Reason:** {reason}",
@@ -2047,7 +4550,7 @@ async def list_sealed_channels_cmd(ctx):
 async def slash_set_log_channel(interaction: discord.Interaction, channel: discord.TextChannel):
     try:
         await interaction.response.defer()
-        set_log_channel(interaction.guild.id, channel.id)
+        await change_log_channel(interaction.guild.id, channel.id, f"Chronicle channel moved by {interaction.user}")
         embed = medieval_response(
             f"The royal chronicles shall now be recorded in {channel.mention}!",
             success=True,
@@ -2063,7 +4566,7 @@ async def slash_set_log_channel(interaction: discord.Interaction, channel: disco
         test_embed.add_field(name="📺 Channel", value=channel.mention, inline=True)
         test_embed.add_field(name="👑 Authority", value=interaction.user.mention, inline=True)
         test_embed.set_footer(text="All server activities will be recorded henceforth!")
-        await channel.send(embed=test_embed)
+        await announce(channel, embed=test_embed)
     except Exception as e:
         await interaction.followup.send(embed=medieval_response(f"Error setting chronicle channel: {str(e)}", success=False))
 @tree.command(name="help", description="View the complete royal charter of commands")
@@ -2134,7 +4637,7 @@ async def slash_pbypass(interaction: discord.Interaction, roles: str):
             ))
         # Set bypass roles
         role_ids = [r.id for r in discord_roles]
-        set_pillory_bypass_roles(interaction.guild.id, role_ids)
+        await run_db(set_pillory_bypass_roles, interaction.guild.id, role_ids)
         role_mentions = " ".join(r.mention for r in discord_roles)
         embed = medieval_embed(
             title="👑 Royal Bypass Privilege",
@@ -2181,7 +4684,7 @@ async def slash_pallow(interaction: discord.Interaction, roles: str):
             ))
         # Set allowed roles
         role_ids = [r.id for r in discord_roles]
-        set_pillory_allowed_roles(interaction.guild.id, role_ids)
+        await run_db(set_pillory_allowed_roles, interaction.guild.id, role_ids)
         role_mentions = " ".join(r.mention for r in discord_roles)
         embed = medieval_embed(
             title="⚔️ Royal Pillory Privileges",
@@ -2302,17 +4805,18 @@ async def slash_mute(interaction: discord.Interaction, member: discord.Member, d
     ctx = MockCtx(interaction)
     await mute_cmd(ctx, member, duration, reason=reason)
 @tree.command(name="purge", description="Cleanse the chat of messages")
-@app_commands.describe(amount="Number of messages to purge (1-100)")
+@app_commands.describe(amount="Number of messages to purge", user="Only purge this subject's messages")
 @app_commands.guild_only
-async def slash_purge(interaction: discord.Interaction, amount: int):
+async def slash_purge(interaction: discord.Interaction, amount: int, user: discord.Member = None):
     await interaction.response.defer()
     class MockCtx:
         def __init__(self, interaction):
             self.author = interaction.user
             self.guild = interaction.guild
-            self.send = interaction.followup.send
+            self.channel = interaction.channel
+            self.send = partial(interaction.followup.send, wait=True)
     ctx = MockCtx(interaction)
-    await purge_cmd(ctx, amount)
+    await purge_cmd(ctx, amount, filters=f"user:{user.id}" if user else None)
 @tree.command(name="seal", description="🔒 Seal a channel to prevent sending messages")
 @app_commands.describe(reason="The reason for sealing this chamber")
 @app_commands.guild_only
@@ -2353,6 +4857,7 @@ async def slash_sealed(interaction: discord.Interaction):
 # ---------- ON READY ----------
 @bot.event
 async def on_ready():
+    global reconcile_task
     try:
         print(f'⚔️ Medieval Moderator Bot hath awakened as {bot.user} (ID: {bot.user.id})')
         print('🎯 Enhanced pillory system ready for dramatic public shaming!')
@@ -2368,18 +4873,66 @@ async def on_ready():
             print(f"✅ Synced {len(synced)} slash commands")
         except Exception as e:
             print(f"❌ Failed to sync slash commands: {e}")
-        # Start background tasks
-        if not check_pillories.is_running():
-            check_pillories.start()
+        # Warm the guild settings cache in one query
+        try:
+            loaded = await run_db(load_all_guild_configs)
+            print(f"✅ Loaded settings for {loaded} realms")
+        except Exception as e:
+            print(f"❌ Failed to load guild settings: {e}")
+        # Arm pillory expiries from the database, then start background tasks
+        try:
+            armed = await schedule_active_pillories()
+            print(f"✅ Armed {armed} pillory expiries")
+        except Exception as e:
+            print(f"❌ Failed to schedule pillory expiries: {e}")
+        try:
+            armed, found, moved, lifted = await reconcile_and_schedule_mutes()
+            print(f"✅ Armed {armed} mute expiries ({found} found, {moved} corrected, {lifted} lifted while away)")
+        except Exception as e:
+            print(f"❌ Failed to reconcile mutes: {e}")
+        expiry_scheduler.start()
+        # Repair roles and seals in the background; a reconnect while one pass is still running skips the next
+        if reconcile_task is None or reconcile_task.done():
+            reconcile_task = bot.loop.create_task(reconcile_realm())
+        if not run_scheduled_jobs.is_running():
+            run_scheduled_jobs.start() # Picks up jobs that fell due while the bot was down
+        if not flush_message_buffer.is_running():
+            flush_message_buffer.start()
+        if not prune_message_history.is_running():
+            prune_message_history.start()
     except Exception as e:
         print(f"Error in on_ready: {e}")
 # ---------- MESSAGE STORAGE ----------
 @bot.event
 async def on_message(message):
     """Store messages for logging"""
-    if not message.author.bot and message.guild:
+    if message.author.bot:
+        return
+    ctx = await bot.get_context(message, cls=RoyalContext)
+    if message.guild:
         store_message(message)
-    await bot.process_commands(message)
+        attachment_archiver.submit(message)
+        # A command its author is allowed to run is moderation at work, not spam or forbidden speech
+        if not await passes_command_checks(ctx):
+            try:
+                if await check_spam(message):
+                    return
+            except Exception as e:
+                print(f"Error in spam guard: {e}")
+            try:
+                if await check_word_filter(message):
+                    return
+            except Exception as e:
+                print(f"Error in word filter: {e}")
+    await bot.invoke(ctx)
+async def passes_command_checks(ctx):
+    """True when the message invokes a command whose checks its author passes"""
+    if not ctx.valid:
+        return False
+    try:
+        return await ctx.command.can_run(ctx)
+    except commands.CommandError:
+        return False
 # ---------- ENHANCED ERROR HANDLER ----------
 @bot.event
 async def on_command_error(ctx, error):
@@ -2480,3 +5033,10 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"Failed to start bot: {e}")
         traceback.print_exc()
+    finally:
+        db_executor.shutdown()
+        try:
+            message_buffer.flush_sync()
+        except Exception as e:
+            print(f"Error flushing message history: {e}")
+        db_pool.close()